@@ -0,0 +1,57 @@
+import collections
+import os
+import resource
+import time
+
+
+class LRUCache:
+    # A dict that forgets its least recently used entries once it holds more than `max_size` of them,
+    # and, if `ttl` is set, entries that are older than `ttl` seconds.
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (value, expiry time or None)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value, expires_at = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        # `ttl` overrides the cache's default, for example to remember that something does not exist for less long.
+        ttl = ttl if ttl is not None else self.ttl
+        self.entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value, _ = self.entries.pop(key, (default, None))
+        return value
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+
+def resident_memory():
+    # Current resident set size in bytes. Falls back to the peak RSS where /proc is not available.
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
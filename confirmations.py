@@ -0,0 +1,91 @@
+import discord
+
+import asyncio
+import functools
+import heapq
+
+CONFIRM = 'confirm'
+CANCEL = 'cancel'
+
+
+class PendingConfirmation:
+    __slots__ = ['future', 'user_id', 'choices', 'deadline']
+    def __init__(self, future, user_id, choices, deadline):
+        self.future = future
+        self.user_id = user_id
+        self.choices = choices
+        self.deadline = deadline
+
+
+class ConfirmationRegistry:
+    # Keeps all confirmations that are waiting for an answer, keyed by the ID of the message or interaction
+    # that asked for confirmation, so that an incoming answer costs one dict lookup, no matter how many are pending.
+    # All timeouts are driven by a single timer, which is always set for the earliest deadline.
+    def __init__(self):
+        self.pending = dict()  # key -> PendingConfirmation
+        self.deadlines = []  # heap of (deadline, key); stale entries are skipped when they come up
+        self.timer = None
+
+    def wait(self, key, user_id, choices, timeout):
+        # Returns a future that resolves to a (choice, interaction) pair, or to None if the confirmation timed out.
+        loop = asyncio.get_event_loop()
+        self.cancel(key)
+        deadline = loop.time() + timeout
+        pending = PendingConfirmation(loop.create_future(), user_id, frozenset(choices), deadline)
+        self.pending[key] = pending
+        heapq.heappush(self.deadlines, (deadline, key))
+        if self.deadlines[0][1] == key:
+            self._schedule(loop)
+        return pending.future
+
+    def resolve(self, key, user_id, choice, interaction=None):
+        pending = self.pending.get(key)
+        if pending is None or pending.user_id != user_id or choice not in pending.choices:
+            return False
+        del self.pending[key]
+        if not pending.future.done():
+            pending.future.set_result((choice, interaction))
+        return True
+
+    def cancel(self, key):
+        pending = self.pending.pop(key, None)
+        if pending is not None and not pending.future.done():
+            pending.future.cancel()
+
+    def _schedule(self, loop):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.deadlines:
+            self.timer = loop.call_at(self.deadlines[0][0], self._expire, loop)
+
+    def _expire(self, loop):
+        self.timer = None
+        now = loop.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            pending = self.pending.get(key)
+            if pending is None or pending.deadline != deadline: continue  # already answered or re-registered
+            del self.pending[key]
+            if not pending.future.done():
+                pending.future.set_result(None)
+        self._schedule(loop)
+
+
+class ConfirmView(discord.ui.View):
+    # Confirm/Cancel buttons that answer a pending confirmation in the registry.
+    # The view itself never times out, because the registry's timer does that.
+    def __init__(self, registry, key, *, confirm_label='Confirm', cancel_label='Cancel', confirm_style=discord.ButtonStyle.success):
+        super().__init__(timeout=None)
+        self.registry = registry
+        self.key = key
+        for choice, label, style in [(CONFIRM, confirm_label, confirm_style), (CANCEL, cancel_label, discord.ButtonStyle.secondary)]:
+            button = discord.ui.Button(label=label, style=style)
+            button.callback = functools.partial(self.answer, choice)
+            self.add_item(button)
+
+    async def answer(self, choice, interaction):
+        if self.registry.resolve(self.key, interaction.user.id, choice, interaction):
+            self.stop()
+        else:
+            await interaction.response.send_message('Only the person who used this command can answer this.', ephemeral=True)
@@ -0,0 +1,103 @@
+import voice
+
+import enum
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger('notifier.digest')
+
+
+class Delivery(enum.Enum):
+    INSTANT = 'instant'  # one notification per event
+    DIGEST = 'digest'  # events are counted and summarized periodically
+
+
+DIGEST_LABELS = {
+    voice.Action.JOINS: 'joins',
+    voice.Action.LEAVES: 'leaves',
+    voice.Action.MUTED: 'mutes',
+    voice.Action.UNMUTED: 'unmutes',
+    voice.Action.DEAFENED: 'deafens',
+    voice.Action.UNDEAFENED: 'undeafens',
+    voice.Action.STREAMING: 'streams started',
+    voice.Action.UNSTREAMING: 'streams stopped',
+}
+
+
+class DigestCounters:
+    # Counts events per destination channel and voice channel, instead of sending a notification for each.
+    # An event that matches several digest rules for the same destination is only counted once.
+    def __init__(self):
+        self.destinations = dict()  # destination channel id -> entry, see `observe`
+
+    def observe(self, destination_id, rule_names, voice_channel_id, action, occupancy):
+        entry = self.destinations.get(destination_id)
+        if entry is None:
+            entry = self.destinations[destination_id] = {'since': time.time(), 'rules': [], 'channels': dict()}
+        for name in rule_names:
+            if name not in entry['rules']:
+                entry['rules'].append(name)
+        channel = entry['channels'].setdefault(str(voice_channel_id), {'counts': dict(), 'peak': 0})
+        channel['counts'][action.value] = channel['counts'].get(action.value, 0) + 1
+        channel['peak'] = max(channel['peak'], occupancy)
+
+    def pop_all(self):
+        destinations = self.destinations
+        self.destinations = dict()
+        return destinations
+
+    def restore(self, destination_id, entry):
+        # Puts back an entry that could not be sent, merging it with anything counted since.
+        current = self.destinations.get(destination_id)
+        if current is None:
+            self.destinations[destination_id] = entry
+            return
+        current['since'] = min(current['since'], entry['since'])
+        current['rules'] += [i for i in entry['rules'] if i not in current['rules']]
+        for voice_channel_id, channel in entry['channels'].items():
+            merged = current['channels'].setdefault(voice_channel_id, {'counts': dict(), 'peak': 0})
+            for action, count in channel['counts'].items():
+                merged['counts'][action] = merged['counts'].get(action, 0) + count
+            merged['peak'] = max(merged['peak'], channel['peak'])
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as file:
+            json.dump({str(k): v for k, v in self.destinations.items()}, file)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path):
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            log.warning('could not read saved digest counters', exc_info=True)
+            return
+        for destination_id, entry in saved.items():
+            self.restore(int(destination_id), entry)
+
+
+def describe_period(seconds):
+    if seconds >= 3600:
+        hours = round(seconds / 3600)
+        return 'hour' if hours == 1 else str(hours) + ' hours'
+    minutes = max(1, round(seconds / 60))
+    return 'minute' if minutes == 1 else str(minutes) + ' minutes'
+
+
+def summary_text(entry, period, limit=2000):
+    # "In the last hour:" followed by one line per voice channel, busiest first, cut off to fit in one message.
+    lines = ['In the last ' + describe_period(period) + ':']
+    channels = sorted(entry['channels'].items(), key=lambda i: sum(i[1]['counts'].values()), reverse=True)
+    for index, (voice_channel_id, channel) in enumerate(channels):
+        counts = ', '.join(str(channel['counts'][action.value]) + ' ' + DIGEST_LABELS[action]
+                           for action in voice.Action if action.value in channel['counts'])
+        line = '<#' + voice_channel_id + '>: ' + counts + ', peak ' + str(channel['peak']) + (' person' if channel['peak'] == 1 else ' people')
+        if len('\n'.join(lines + [line])) > limit - 40:
+            lines.append('and ' + str(len(channels) - index) + ' more voice channels')
+            break
+        lines.append(line)
+    return '\n'.join(lines)
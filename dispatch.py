@@ -0,0 +1,62 @@
+import discord
+
+MESSAGE_LIMIT = 2000
+RULE_LIST_LIMIT = 3900  # embed descriptions may be up to 4096 characters
+
+
+class PlannedMessage:
+    __slots__ = ['channel_id', 'channel', 'content', 'rules', 'allowed_mentions']
+    def __init__(self, channel_id, channel, content, rules, allowed_mentions):
+        self.channel_id = channel_id
+        self.channel = channel
+        self.content = content
+        self.rules = rules  # the rules that caused this message; only set on the first message for a channel
+        self.allowed_mentions = allowed_mentions
+
+
+def allowed_mentions_for(userlikes):
+    # Only the members and roles mentioned by the rules may be pinged, never @everyone or whatever is in a user's name.
+    return discord.AllowedMentions(everyone=False,
+                                   users=[discord.Object(i.id) for i in userlikes if i.type.value == 'member'],
+                                   roles=[discord.Object(i.id) for i in userlikes if i.type.value == 'role'])
+
+
+def plan(rules, notification_text):
+    # Groups the rules by destination channel, merges their mentions without duplicates (keeping the order
+    # in which they were first mentioned), and splits each channel's mentions over as few messages as possible.
+    # The first message for a channel carries the notification text.
+    channels = dict()  # channel id -> (rules, {(type, id) -> userlike})
+    for rule in rules:
+        rules_for_channel, mentions = channels.setdefault(rule.channel_to_mention_id, ([], dict()))
+        rules_for_channel.append(rule)
+        for userlike in rule.users_to_mention or []:
+            mentions.setdefault((userlike.type, userlike.id), userlike)
+
+    messages = []
+    for channel_id, (rules_for_channel, mentions) in channels.items():
+        chunks = [[]]
+        length = len(notification_text)  # the first message is "mentions... text"
+        for userlike in mentions.values():
+            added = len(userlike.as_mention()) + 1
+            if length + added > MESSAGE_LIMIT:
+                chunks.append([])
+                length = -1  # later messages only have mentions, separated by spaces
+            chunks[-1].append(userlike)
+            length += added
+        for index, chunk in enumerate(chunks):
+            content = ' '.join(i.as_mention() for i in chunk)
+            if index == 0:
+                content = (content + ' ' + notification_text) if content else notification_text
+            messages.append(PlannedMessage(channel_id, rules_for_channel[0].channel_to_mention, content, rules_for_channel if index == 0 else None, allowed_mentions_for(chunk)))
+    return messages
+
+
+def rule_list_text(rules):
+    names = ['`'+rule.name+'`' for rule in rules]
+    text = ', '.join(names)
+    if len(text) <= RULE_LIST_LIMIT: return text
+    shown = []
+    for name in names:
+        if len(', '.join(shown + [name])) > RULE_LIST_LIMIT - 20: break
+        shown.append(name)
+    return ', '.join(shown) + ' and ' + str(len(names) - len(shown)) + ' more'
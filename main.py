@@ -1,8 +1,23 @@
 import discord
-from discord.ext import commands
-import motor.motor_asyncio
+from discord.ext import commands, tasks
 import pymongo
 import names
+import cache
+import confirmations
+import digest
+import dispatch
+import permissions
+import profiling
+import recording
+import reporting
+import resilience
+import resolver
+import schedule
+import scheduler
+import storage
+import voice
+from voice import Action
+from digest import Delivery
 from fuzzywuzzy import process as fwproc
 
 import os
@@ -11,20 +26,91 @@ import enum
 import random
 import datetime
 import hashlib
+import io
+import time
 import traceback
 import asyncio
+import signal
 
 TOKEN = os.getenv('DISCORD_TOKEN')
 
+log_listener = reporting.setup_logging()
+log = reporting.log
+permission_cache = permissions.PermissionCache(denied_ttl=int(os.getenv('PERMISSION_DENIED_TTL') or 60))
+reporter = reporting.ErrorReporter(permission_cache,
+                                   dedup_window=int(os.getenv('ERROR_DEDUP_WINDOW') or 300),
+                                   reports_per_guild=int(os.getenv('ERROR_REPORTS_PER_GUILD') or 3),
+                                   report_period=int(os.getenv('ERROR_REPORT_PERIOD') or 60))
+
 intents = discord.Intents.default()
 intents.typing = False
 intents.presences = False
 intents.voice_states = True
-
-bot = commands.Bot(command_prefix=os.getenv('BOT_COMMAND_PREFIX') or '>', intents=intents)
-
-client = motor.motor_asyncio.AsyncIOMotorClient('mongodb://mongo:27017/')#, username='root', password='rootpassword')
-db = client.db
+intents.message_content = True  # needed for prefix commands
+
+LOW_MEMORY_MODE = (os.getenv('LOW_MEMORY_MODE') or 'no') == 'yes'
+bot_options = {}
+if LOW_MEMORY_MODE:
+    # Only keep members that are in a voice channel, do not download member lists at startup, and do not keep messages.
+    # Everything else about members is fetched when needed, into a bounded cache.
+    intents.emojis_and_stickers = False
+    intents.guild_scheduled_events = False
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    bot_options = {'member_cache_flags': member_cache_flags, 'chunk_guilds_at_startup': False, 'max_messages': None}
+
+def parse_shard_ids(text):
+    # "0-3" or "0,2,5"
+    shard_ids = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            shard_ids += range(int(first), int(last)+1)
+        else:
+            shard_ids.append(int(part))
+    return shard_ids
+
+# Sharding: with AUTO_SHARD=yes one process runs as many shards as Discord recommends.
+# To split the bot over several processes, give each process the same SHARD_COUNT and its own SHARD_IDS.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS')) if os.getenv('SHARD_IDS') else None
+if SHARD_COUNT is not None:
+    bot = commands.AutoShardedBot(command_prefix=os.getenv('BOT_COMMAND_PREFIX') or '>', intents=intents,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options)
+elif (os.getenv('AUTO_SHARD') or 'no') == 'yes':
+    bot = commands.AutoShardedBot(command_prefix=os.getenv('BOT_COMMAND_PREFIX') or '>', intents=intents, **bot_options)
+else:
+    bot = commands.Bot(command_prefix=os.getenv('BOT_COMMAND_PREFIX') or '>', intents=intents, **bot_options)
+
+fetched_members = cache.LRUCache(int(os.getenv('MEMBER_CACHE_SIZE') or 4096), ttl=int(os.getenv('MEMBER_CACHE_TTL') or 600))  # (guild id, member id) -> Member or None
+model_resolver = resolver.ModelResolver(fetched_members,
+                                        negative_ttl=int(os.getenv('MEMBER_NOT_FOUND_TTL') or 300),
+                                        role_ttl=int(os.getenv('MEMBER_CACHE_TTL') or 600))
+
+confirmation_registry = confirmations.ConfirmationRegistry()
+
+store = resilience.ResilientRuleStore(storage.store_from_env(),
+                                      timeout=float(os.getenv('STORE_TIMEOUT') or 2),
+                                      snapshot_timeout=float(os.getenv('STORE_SNAPSHOT_TIMEOUT') or 30),
+                                      failure_threshold=int(os.getenv('STORE_FAILURE_THRESHOLD') or 3),
+                                      reset_timeout=float(os.getenv('STORE_RESET_TIMEOUT') or 30),
+                                      scope=lambda: [guild.id for guild in bot.guilds])  # only our own shards' guilds
+rule_index = voice.RuleIndex(store)
+mention_index = voice.MentionIndex(store)
+schedule_index = schedule.ScheduleIndex(store)
+
+def parse_guild_weights(text):
+    # "guild id:weight,guild id:weight"
+    weights = {}
+    for part in text.split(','):
+        guild_id, weight = part.split(':')
+        weights[int(guild_id)] = int(weight)
+    return weights
+
+event_scheduler = scheduler.GuildScheduler(workers=int(os.getenv('EVENT_WORKERS') or 8),
+                                           max_in_flight_per_guild=int(os.getenv('EVENT_IN_FLIGHT_PER_GUILD') or 2),
+                                           max_queued_per_guild=int(os.getenv('EVENT_QUEUE_PER_GUILD') or 1000),
+                                           weights=parse_guild_weights(os.getenv('EVENT_GUILD_WEIGHTS')) if os.getenv('EVENT_GUILD_WEIGHTS') else None)
 
 async def generate_name_indexes(attempts = 50):
     for _ in range(attempts):
@@ -32,7 +118,7 @@ async def generate_name_indexes(attempts = 50):
         center_ind = random.randint(0, len(names.CENTER)-1)
         right_ind = random.randint(0, len(names.RIGHT)-1)
         indexes = [left_ind, center_ind, right_ind]
-        existing = await db.rules.find_one({'name_indexes': indexes})
+        existing = await store.get_by_name(indexes)
         if existing is not None:
             continue
 
@@ -78,10 +164,11 @@ class Userlike:
         raise TypeError('unknown type: ', type(model))
     
     async def as_discord_model(self, guild):
+        # Returns None if the member left or the role was deleted.
         if self.type == UserlikeType.MEMBER:
-            return guild.get_member(self.id) or await guild.fetch_member(self.id)
+            return await model_resolver.member(guild, self.id)
         elif self.type == UserlikeType.ROLE:
-            return guild.get_role(self.id) or await guild.fetch_role(self.id)
+            return await model_resolver.role(guild, self.id)
         else:
             raise TypeError('Unexpected type of self:', self.type)
 
@@ -94,16 +181,6 @@ class Userlike:
     def to_json(self):
         return {'type': self.type.value, 'id': self.id}
 
-class Action(enum.Enum):
-    JOINS = 'joins'
-    LEAVES = 'leaves'
-    MUTED = 'muted'
-    UNMUTED = 'unmuted'
-    DEAFENED = 'deafened'
-    UNDEAFENED = 'undeafened'
-    STREAMING = 'streaming'
-    UNSTREAMING = 'unstreaming'
-
 ACTION_MESSAGES = {
     Action.JOINS: '{user} joined channel {channel}',
     Action.LEAVES: '{user} left channel {channel}',
@@ -127,12 +204,18 @@ ACTION_VERBS = {
 }
 
 class Trigger:
-    __slots__ = ['userlike', 'action', 'channel']
-    def __init__(self, *, userlike=None, action=None, channel=None):
+    __slots__ = ['userlike', 'action', 'channel', 'channel_id']
+    def __init__(self, *, userlike=None, action=None, channel=None, guild=None):
         if userlike is not None and not isinstance(userlike, Userlike):
             userlike = Userlike(**userlike)
         self.userlike = userlike
-        if channel is not None and not isinstance(channel, discord.VoiceChannel): raise TypeError('channel must be a VoiceChannel, not' + str(type(channel)))
+        if isinstance(channel, int):
+            # stored rules only have the channel ID; keep it even if the channel no longer exists
+            self.channel_id = channel
+            channel = guild.get_channel(channel) if guild else None
+        elif channel is not None and not isinstance(channel, discord.VoiceChannel): raise TypeError('channel must be a VoiceChannel, not' + str(type(channel)))
+        else:
+            self.channel_id = channel.id if channel else None
         self.channel = channel
         if action is not None:
             action = Action(action)
@@ -141,98 +224,93 @@ class Trigger:
     def to_json(self):
         return {'userlike': self.userlike.to_json() if self.userlike else None,
                 'action': self.action.value,
-                'channel': self.channel.id if self.channel else None}
+                'channel': self.channel_id}
 
 class Event:
     def __init__(self, *, user, state_before, state_after):
         self.channel = state_before.channel or state_after.channel
         self.user = user
-        self.action = None
-        if state_before.channel is None and state_after.channel is not None:
-            self.action = Action.JOINS
-            return
-        if state_after.channel is None and state_before.channel is not None:
-            self.action = Action.LEAVES
-            return
-        
-        # it is important to check for deafening before muting, because the default Discord client applies both changes at the same time
-        if (state_before.deaf + state_before.self_deaf) < (state_after.deaf + state_after.self_deaf):
-            self.action = Action.DEAFENED
-            return
-        if (state_before.deaf + state_before.self_deaf) > (state_after.deaf + state_after.self_deaf):
-            self.action = Action.UNDEAFENED
-            return
-        
-        if (state_before.mute + state_before.self_mute) < (state_after.mute + state_after.self_mute):
-            self.action = Action.MUTED
-            return
-        if (state_before.mute + state_before.self_mute) > (state_after.mute + state_after.self_mute):
-            self.action = Action.UNMUTED
-            return
-        
-        if (state_before.self_stream + state_before.self_video) < (state_after.self_stream + state_after.self_video):
-            self.action = Action.STREAMING
-            return
-        if (state_before.self_stream + state_before.self_video) > (state_after.self_stream + state_after.self_video):
-            self.action = Action.UNSTREAMING
-            return
-
+        before, after = voice.flags_from_state(state_before), voice.flags_from_state(state_after)
+        self.transition = (before, after, state_after.session_id or state_before.session_id)
+        self.action = voice.classify(before, after)
         if self.action == None:
             raise ValueError('No change detected between two states:', state_before, state_after)
 
+    @classmethod
+    def from_action(cls, user, action, channel, transition=None):
+        # For events that were already classified, such as by the raw fast path.
+        # `transition` is (before flags, after flags, voice session ID), see voice.RecentEvents.
+        self = cls.__new__(cls)
+        self.user = user
+        self.action = action
+        self.channel = channel
+        self.transition = transition
+        return self
+
     def __repr__(self):
         return f'Event<user={repr(self.user)}, action={repr(self.action)}, channel={repr(self.channel)}>'
 
-    async def lookup_rules(self):
-        q = []
-        
-        # match user
-        this_user = {'trigger.userlike.type': UserlikeType.MEMBER.value,
-                     'trigger.userlike.id': self.user.id}
-        
-        # match roles of user
-        role_queries = []
-        for role in self.user.roles:
-            role_queries.append({'trigger.userlike.id': role.id})
-
-        these_roles = {'$and':
-                          [
-                            {'trigger.userlike.type': UserlikeType.ROLE.value},
-                            {'$or': role_queries}
-                          ]
-                      }
-
-        # rule does not limit user
-        no_user_limitation = {'trigger.userlike': None}
-
-        correct_user = {'$or': [this_user, these_roles, no_user_limitation]}
-
-        correct_action = {'trigger.action': self.action.value}
-
-        correct_channel = {'$or': [{'trigger.channel': self.channel.id}, {'trigger.channel': None}]}
-        
-        compound_query = {'$and': [{'guild': self.user.guild.id}, correct_user, correct_action, correct_channel]}
-        rules = await db.rules.find(compound_query).to_list(None)
+    async def lookup_rules(self, now=None):
+        # `now` is for replaying recorded events at the time they happened.
+        rules = await store.lookup(self.user.guild.id, self.user.id, [role.id for role in self.user.roles], self.action.value, self.channel.id)
         rules = rules or []
+        if any(i.get('schedule') for i in rules):
+            inactive = schedule_index.inactive(self.user.guild.id, now)
+            if inactive is None:
+                rules = [i for i in rules if schedule.is_active(i.get('schedule'), now)]
+            else:
+                rules = [i for i in rules if tuple(i['name_indexes']) not in inactive]
         rules = [Rule(**i) for i in rules]
 
         return rules
 
 class Rule:
-    def __init__(self, *, guild, trigger, channel_to_mention, users_to_mention, name_indexes=None, **kwargs):
+    def __init__(self, *, guild, trigger, channel_to_mention, users_to_mention, name_indexes=None, disabled=False, delivery=Delivery.INSTANT, schedule=None, **kwargs):
         if isinstance(guild, discord.Guild):
             self.guild = guild
+            self.guild_id = guild.id
         else:
             self.guild = bot.get_guild(guild)
+            self.guild_id = guild
         if not isinstance(trigger, Trigger):
-            trigger = Trigger(**trigger)
+            trigger = Trigger(guild=self.guild, **trigger)
         self.trigger = trigger
         users_to_mention = users_to_mention or []
-        if not isinstance(channel_to_mention, discord.TextChannel):
-            channel_to_mention = self.guild.get_channel(channel_to_mention)
+        if isinstance(channel_to_mention, discord.TextChannel):
+            self.channel_to_mention_id = channel_to_mention.id
+        else:
+            # the channel may have been deleted, in which case this stays None and the rule is broken
+            self.channel_to_mention_id = channel_to_mention
+            channel_to_mention = self.guild.get_channel(channel_to_mention) if self.guild else None
         self.channel_to_mention = channel_to_mention
         self.users_to_mention = [Userlike(**i) if isinstance(i, dict) else Userlike.from_discord_model(i) if isinstance(i, discord.Role) or isinstance(i, discord.Member) else i for i in users_to_mention if i]
         self.name_indexes = name_indexes
+        self.disabled = disabled
+        self.delivery = Delivery(delivery)
+        self.schedule = schedule
+
+    async def missing_references(self):
+        # Returns a list of things this rule refers to that no longer exist.
+        # Roles and channels are checked locally; members may need an API call, because they are not always cached
+        # (see `prefetch_members` to look up the members of many rules at once).
+        if self.guild is None: return ['guild']
+        missing = []
+        if self.channel_to_mention is None:
+            missing.append('channel_to_mention')
+        if self.trigger.channel_id is not None and self.trigger.channel is None:
+            missing.append('trigger.channel')
+        for path, userlike in [('trigger.userlike', self.trigger.userlike)] + [('users_to_mention', i) for i in self.users_to_mention]:
+            if userlike is None: continue
+            if userlike.type == UserlikeType.ROLE:
+                # the role cache is always complete, so a miss means the role was deleted
+                if self.guild.get_role(userlike.id) is None: missing.append(path)
+                continue
+            if await userlike.as_discord_model(self.guild) is None:
+                missing.append(path)
+        return missing
+
+    def member_ids(self):
+        return [i.id for i in [self.trigger.userlike] + self.users_to_mention if i is not None and i.type == UserlikeType.MEMBER]
 
     @property
     def name(self):
@@ -265,196 +343,348 @@ class Rule:
         emb.add_field(name='Does this action', value=ACTION_VERBS[self.trigger.action])
         if self.trigger.channel:
             emb.add_field(name='In this voice channel', value=self.trigger.channel.mention)
-        emb.add_field(name='Then write to this text channel', value=self.channel_to_mention.mention)
+        emb.add_field(name='Then write to this text channel', value=self.channel_to_mention.mention if self.channel_to_mention else '(deleted channel)')
         if len(self.users_to_mention or []) != 0:
             emb.add_field(name='While mentioning these', value=' '.join(map(lambda x: x.as_mention(), self.users_to_mention)))
+        if self.schedule:
+            emb.add_field(name='Only during', value=self.schedule['text'] + ('' if self.schedule['timezone'] in self.schedule['text'] else ' (' + self.schedule['timezone'] + ')'))
+        if self.delivery == Delivery.DIGEST:
+            emb.add_field(name='As a summary', value='every ' + digest.describe_period(DIGEST_INTERVAL) + ', without mentions')
         return emb
 
-    async def send_notification(self, event):
-        notification_text = ' '.join(map(lambda x: x.as_mention(), self.users_to_mention))
-        notification_text += ' ' + ACTION_MESSAGES[self.trigger.action].format(user=event.user, channel=event.channel)
-        emb = discord.Embed()
-        emb.color = self.color
-        emb.description = 'This notification was created by rule `'+self.name+'`.'
-        emb.timestamp = datetime.datetime.now()
-        await self.channel_to_mention.send(content=notification_text, embed=emb)
-
-    @staticmethod
-    async def send_notifications_for_list(event, rules):
-        notification_text = ACTION_MESSAGES[rules[0].trigger.action].format(user=event.user, channel=event.channel)
-        mentions = dict()
-        contributing_rules = dict()
-        for rule in rules:
-            mentions[rule.channel_to_mention] = mentions.get(rule.channel_to_mention, []) + (rule.users_to_mention or [])
-            contributing_rules[rule.channel_to_mention] = contributing_rules.get(rule.channel_to_mention, []) + [rule]
-        
-        for channel in contributing_rules:
+    def to_json(self):
+        return {'guild': self.guild_id,
+                'trigger': self.trigger.to_json(),
+                'channel_to_mention': self.channel_to_mention_id,
+                'users_to_mention': [i.to_json() for i in self.users_to_mention],
+                'name_indexes': self.name_indexes,
+                'delivery': self.delivery.value,
+                'schedule': self.schedule}
+
+
+
+
+def channel_occupancy(channel):
+    if RAW_VOICE_FAST_PATH:  # discord.py's voice states are not kept up to date then
+        return voice_states.occupancy[(channel.guild.id, channel.id)]
+    return len(channel.voice_states)
+
+def count_for_digest(event, rules):
+    # Each event is counted once per destination, however many of its digest rules matched.
+    occupancy = channel_occupancy(event.channel)
+    destinations = dict()
+    for rule in rules:
+        destinations.setdefault(rule.channel_to_mention_id, []).append(rule.name)
+    for destination_id, rule_names in destinations.items():
+        digest_counters.observe(destination_id, rule_names, event.channel.id, event.action, occupancy)
+
+async def send_notifications(event, rules):
+    digest_rules = [i for i in rules if i.delivery == Delivery.DIGEST]
+    if digest_rules:
+        count_for_digest(event, digest_rules)
+        rules = [i for i in rules if i.delivery != Delivery.DIGEST]
+        if not rules: return
+    notification_text = ACTION_MESSAGES[event.action].format(user=event.user, channel=event.channel)
+    for planned in dispatch.plan(rules, notification_text):
+        if not permission_cache.can_send(planned.channel):
+            log.info('skipping notification, cannot send to destination', extra={'fields': {'rules': [i.name for i in planned.rules or []], 'channel': planned.channel_id}})
+            continue
+        emb = None
+        if planned.rules:
             emb = discord.Embed()
-            rules_for_channel = contributing_rules[channel]
             emb.timestamp = datetime.datetime.now()
-            if len(rules_for_channel)>1:
+            if len(planned.rules)>1:
                 emb.color = discord.Color.random() # because multiple rules are being applied, no one color may be used.
-                emb.description = 'This notification was created by these rules: `' + '`, `'.join([i.name for i in rules_for_channel])+'`.'
+                emb.description = 'This notification was created by these rules: ' + dispatch.rule_list_text(planned.rules) + '.'
             else:
-                emb.color = rules_for_channel[0].color
-                emb.description = 'This notification was created by rule `'+rules_for_channel[0].name+'`.' 
-            mentions_for_channel = ' '.join([i.as_mention() for i in mentions[channel]])
-            try:
-                await channel.send(content=mentions_for_channel + ' ' + notification_text, embed=emb)
-            except discord.Forbidden: pass
-            
-        
-    def to_json(self):
-        return {'guild': self.guild.id,
-                'trigger': self.trigger.to_json(),
-                'channel_to_mention': self.channel_to_mention.id,
-                'users_to_mention': [i.to_json() for i in self.users_to_mention],
-                'name_indexes': self.name_indexes}
+                emb.color = planned.rules[0].color
+                emb.description = 'This notification was created by rule `'+planned.rules[0].name+'`.'
+        try:
+            await planned.channel.send(content=planned.content, embed=emb, allowed_mentions=planned.allowed_mentions)
+        except discord.Forbidden:
+            permission_cache.forget_channel(planned.channel)  # our cached permissions were stale
 
+class Responder:
+    # Lets the rule commands answer both prefix commands and slash commands.
+    # A slash command must be answered within 3 seconds, which the rule store does not promise, so slash commands
+    # defer first and then answer with followups; every path through the commands, including errors, answers.
+    def __init__(self, *, ctx=None, interaction=None):
+        self.ctx = ctx
+        self.interaction = interaction
+        self.message = None
 
+    @property
+    def key(self):
+        return self.ctx.message.id if self.ctx else self.interaction.id
 
+    @property
+    def author(self):
+        return self.ctx.author if self.ctx else self.interaction.user
 
-@bot.command(brief='Add a notification rule.',
-help='''Add a rule to send notifications on voice channel events.
+    @property
+    def guild(self):
+        return self.ctx.guild if self.ctx else self.interaction.guild
 
-All parameters are optional.
-- who: user or role that performs an action, default is "everyone".
-- does_what: what action is performed, default is "joins", valid options are: ''' + ', '.join(map(lambda x: x.value, Action)) + '''.
-- in_where: name of voice channel in which the action is performed, default is "every voice channel". If this is multiple words, enclose it in "quotation marks".
-- tell_who: which users will be mentioned when the event happens.''')
-@discord.ext.commands.guild_only()
-async def add_rule(ctx,
-                   who: typing.Optional[typing.Union[discord.Member, discord.Role]]=None,
-                   does_what: typing.Optional[str]=Action.JOINS,
-                   in_where: typing.Optional[discord.VoiceChannel]=None,
-                   tell_who: discord.ext.commands.Greedy[typing.Union[discord.Member, discord.Role]]=None):
+    @property
+    def channel(self):
+        return self.ctx.channel if self.ctx else self.interaction.channel
+
+    @property
+    def author_is_manager(self):
+        return self.channel.permissions_for(self.author).manage_guild
+
+    async def defer(self):
+        if self.interaction and not self.interaction.response.is_done():
+            await self.interaction.response.defer(thinking=True)
+
+    async def send(self, content=None, **kwargs):
+        if self.ctx:
+            self.message = await self.ctx.send(content, **kwargs)
+        elif self.interaction.response.is_done():
+            # the first followup replaces the "thinking" message, so edit_original_response still edits it
+            self.message = await self.interaction.followup.send(content, wait=True, **kwargs)
+        else:
+            await self.interaction.response.send_message(content, **kwargs)
+
+    async def edit(self, **kwargs):
+        if self.ctx:
+            await self.message.edit(**kwargs)
+        else:
+            await self.interaction.edit_original_response(**kwargs)
+
+    async def report_error(self, exception):
+        if self.ctx:
+            await on_command_error(self.ctx, exception)
+        else:
+            await on_command_error(None, exception, guild=self.guild)
+            try:
+                await self.send('An error occurred, this command did not complete.', ephemeral=True)
+            except discord.HTTPException:
+                pass  # the interaction expired
+
+async def confirm(responder, content, embed, **view_options):
+    # Sends the question with Confirm/Cancel buttons and waits for the author to click one.
+    # Returns (choice, interaction), where the interaction should be used to give the final answer,
+    # or None if the confirmation timed out, in which case the question was already edited to say so.
+    view = confirmations.ConfirmView(confirmation_registry, responder.key, **view_options)
+    confirmation = confirmation_registry.wait(responder.key, responder.author.id, [confirmations.CONFIRM, confirmations.CANCEL], timeout=120)
+    try:
+        await responder.send(content, embed=embed, view=view)
+    except Exception:
+        confirmation_registry.cancel(responder.key)
+        raise
+    answer = await confirmation
+    if answer is None:
+        view.stop()
+        await responder.edit(content='Confirmation timed out, to confirm this action please repeat the command.', view=None)
+    return answer
+
+async def create_rule(responder, who, does_what, in_where, tell_who, delivery=Delivery.INSTANT):
     try:
         if who is not None:
             who = Userlike.from_discord_model(who)
         try:
             does_what = Action(does_what)
         except ValueError:
-            await ctx.send('Action `'+does_what+'` is not recognized, valid options are: `'+'`, `'.join(map(lambda x: x.value, Action))+'`.')
+            await responder.send('Action `'+does_what+'` is not recognized, valid options are: `'+'`, `'.join(map(lambda x: x.value, Action))+'`.')
+            return
         trig = Trigger(userlike=who, action=does_what, channel=in_where)
-        rule = Rule(guild=ctx.channel.guild, trigger=trig, channel_to_mention=ctx.channel, users_to_mention=tell_who)
+        rule = Rule(guild=responder.guild, trigger=trig, channel_to_mention=responder.channel, users_to_mention=tell_who, delivery=delivery)
         chk = rule.to_json()
         del chk['name_indexes']
-        existing = await db.rules.find_one(chk)
+        existing = await store.find_identical(chk)
         if existing:
             rule = Rule(**existing)
-            await ctx.send(content='A rule that is identical to this one already exists, not registering.', embed=rule.as_embed())
+            await responder.send(content='A rule that is identical to this one already exists, not registering.', embed=rule.as_embed())
             return
 
         await rule.generate_name()
-        member_is_manager = ctx.author.permissions_in(ctx.channel).manage_guild
-        if not member_is_manager:
-            tell_who = tell_who or [ctx.author]
-            if len(tell_who)>1 or tell_who[0] != ctx.author:
-                ctx.send(ctx.author.mention+''', you have tried to mention people other than yourself with this rule without having the "Manage Server" permission.
+        if not responder.author_is_manager:
+            tell_who = tell_who or [responder.author]
+            if len(tell_who)>1 or tell_who[0] != responder.author:
+                await responder.send(responder.author.mention+''', you have tried to mention people other than yourself with this rule without having the "Manage Server" permission.
 Please edit your rule to exclude other users from the list of people to be notified.''', embed=rule.as_embed())
                 return
-        
-        CHECK_MARK = '✅'
-        CANCEL_MARK = '❌'
-        emojis = [CHECK_MARK, CANCEL_MARK]
-        msg = await ctx.send('Here is your new rule. Please confirm the parameters, then click '+CHECK_MARK+' to confirm or '+CANCEL_MARK+' to cancel.', embed=rule.as_embed())
-        try:
-            await msg.add_reaction(CHECK_MARK)
-            await msg.add_reaction(CANCEL_MARK)
-        except discord.Forbidden:
-            await msg.edit(content='This bot cannot add reactions to messages, but this is required.')
-            await cannot_add_reactions(ctx)
-            return
-        try:
-            reaction, _ = await bot.wait_for('reaction_add',
-                                             check=lambda r, u: r.emoji in emojis and r.message.id == msg.id and u == ctx.author,
-                                             timeout=120)
-        except asyncio.TimeoutError:
-            await msg.edit(content='Rule confirmation timed out, to confirm this rule please repeat the command.')
-            try:
-                await msg.clear_reactions()
-            except discord.Forbidden:
-                await cannot_clear_reactions(ctx)
-        reaction = reaction.emoji
-        if reaction == CANCEL_MARK:
-            await msg.edit(content='Rule cancelled, this rule will not be applied.')
-            try:
-                await msg.clear_reactions()
-            except discord.Forbidden:
-                await cannot_clear_reactions(ctx)
-        elif reaction == CHECK_MARK:
-            await db.rules.insert_one(rule.to_json())
-            await msg.edit(content='Rule confirmed.')
-            try:
-                await msg.clear_reactions()
-            except discord.Forbidden:
-                await cannot_clear_reactions(ctx)
+
+        answer = await confirm(responder, 'Here is your new rule. Please confirm the parameters, then click Confirm or Cancel.', rule.as_embed())
+        if answer is None: return
+        choice, interaction = answer
+        if choice == confirmations.CANCEL:
+            await interaction.response.edit_message(content='Rule cancelled, this rule will not be applied.', view=None)
+        elif choice == confirmations.CONFIRM:
+            await interaction.response.defer()  # the click must be answered within 3 seconds, too
+            await store.insert(rule.to_json())
+            await interaction.edit_original_response(content='Rule confirmed.', view=None)
     except Exception as e:
-        await on_command_error(ctx, e)
+        await responder.report_error(e)
 
-@bot.command(brief='Delete an existing notification rule.',
-help='''Display and optionally delete an existing rule by name.
-To view the rules active in this channel, use the "show_rules" command.''')
-async def del_rule(ctx, name):
+async def find_rule(responder, name):
+    # Returns (rule, prefix) for a rule in the responder's guild, where prefix is a note to put before the answer,
+    # or None if there is no such rule, in which case the responder was already told.
     indexes, exact = parse_name_indexes(*(name.split('-')))
     prefix = ''
     if not exact:
         true_name = name_indexes_to_words(indexes)
         prefix += 'NOTE: Name `'+name+'` is not valid, assuming `'+true_name+'`.\n'
         name = true_name
-    rule = await db.rules.find_one({'name_indexes': indexes})
+    rule = await store.get_by_name(indexes)
     if not rule:
-        await ctx.send(prefix + 'The rule by name `'+name+'` does not exist.')
-        return
+        await responder.send(prefix + 'The rule by name `'+name+'` does not exist.')
+        return None
     rule = Rule(**rule)
-    if rule.guild != ctx.guild:
-        await ctx.send(prefix + 'A rule by name `'+name+'` was found, but it belongs to a different server so we cannot show it to you.')
-
-
-    member_is_manager = ctx.author.permissions_in(ctx.channel).manage_guild
+    if rule.guild != responder.guild:
+        await responder.send(prefix + 'A rule by name `'+name+'` was found, but it belongs to a different server so we cannot show it to you.')
+        return None
+    return rule, prefix
+
+def may_change_rule(responder, rule):
+    # If a rule mentions users, it can be changed by a server manager or by the only user mentioned.
+    member_is_manager = responder.author_is_manager
     mentions_nobody = len(rule.users_to_mention or [])==0
     mentions_only_me = False
     if rule.users_to_mention:
-        mentions_only_me = rule.users_to_mention[0] == Userlike.from_discord_model(ctx.author)
-    
+        mentions_only_me = rule.users_to_mention[0] == Userlike.from_discord_model(responder.author)
+    return member_is_manager or mentions_nobody or mentions_only_me
+
+async def delete_rule(responder, name):
+    found = await find_rule(responder, name)
+    if found is None: return
+    rule, prefix = found
+    indexes = rule.name_indexes
 
-    if not (member_is_manager or mentions_nobody or mentions_only_me):
-        await ctx.send(content=prefix + 'This rule was found, but it mentions users other than you. '+\
+    if not may_change_rule(responder, rule):
+        await responder.send(content=prefix + 'This rule was found, but it mentions users other than you. '+\
             'If a rule mentions users, it can be removed by a server manager or by the only user mentioned, if applicable.', embed=rule.as_embed())
         return
     
 
-    TRASH = '🗑️'
-    CANCEL_MARK = '🚫'
-    emojis = [TRASH, CANCEL_MARK]
-    msg = await ctx.send(content=prefix + 'This rule was found, do you want to delete it? '+TRASH+' for yes, '+CANCEL_MARK+' for no.', embed=rule.as_embed())
+    answer = await confirm(responder, prefix + 'This rule was found, do you want to delete it?', rule.as_embed(),
+                           confirm_label='Delete', confirm_style=discord.ButtonStyle.danger)
+    if answer is None: return
+    choice, interaction = answer
+    if choice == confirmations.CANCEL:
+        await interaction.response.edit_message(content='This rule will not be deleted.', view=None)
+    elif choice == confirmations.CONFIRM:
+        await interaction.response.defer()  # the click must be answered within 3 seconds, too
+        await store.delete_by_name(indexes)
+        await interaction.edit_original_response(content='This rule was successfully deleted', view=None)
+
+async def change_delivery(responder, name, delivery):
     try:
-        await msg.add_reaction(TRASH)
-        await msg.add_reaction(CANCEL_MARK)
-    except discord.Forbidden:
-        await msg.edit(content='This bot cannot add reactions to messages, but this is required.')
-        await cannot_add_reactions(ctx)
+        delivery = Delivery(delivery)
+    except ValueError:
+        await responder.send('Delivery `'+str(delivery)+'` is not recognized, valid options are: `'+'`, `'.join(i.value for i in Delivery)+'`.')
         return
-    try:
-        reaction, _ = await bot.wait_for('reaction_add',
-                                         check=lambda r, u: r.emoji in emojis and r.message.id == msg.id and u == ctx.author,
-                                         timeout=120)
-    except asyncio.TimeoutError:
-        await msg.edit(content='Confirmation timed out, to confirm this action please repeat the command.')
+    found = await find_rule(responder, name)
+    if found is None: return
+    rule, prefix = found
+    if not may_change_rule(responder, rule):
+        await responder.send(content=prefix + 'This rule was found, but it mentions users other than you. '+\
+            'If a rule mentions users, it can be changed by a server manager or by the only user mentioned, if applicable.', embed=rule.as_embed())
+        return
+    if rule.delivery == delivery:
+        await responder.send(content=prefix + 'This rule already uses this delivery.', embed=rule.as_embed())
+        return
+    await store.update_by_name(rule.name_indexes, {'delivery': delivery.value})
+    rule.delivery = delivery
+    await responder.send(content=prefix + ('From now on, this rule is summarized periodically.' if delivery == Delivery.DIGEST else 'From now on, this rule notifies for every event.'), embed=rule.as_embed())
+
+async def change_schedule(responder, name, text):
+    if text.strip().lower() in ('', 'always'):
+        new_schedule = None
+    else:
         try:
-            await msg.clear_reactions()
-        except discord.Forbidden:
-            await cannot_clear_reactions(ctx)
-    reaction = reaction.emoji
-    if reaction == CANCEL_MARK:
-        await msg.edit(content='This rule will not be deleted.')
-    elif reaction == TRASH:
-        await db.rules.delete_one({'name_indexes': indexes})
-        await msg.edit(content='This rule was successfully deleted')
-    try:
-        await msg.clear_reactions()
-    except discord.Forbidden:
-        await cannot_clear_reactions(ctx)
+            new_schedule = schedule.parse_schedule(text)
+        except ValueError as e:
+            await responder.send('Schedule `'+text+'` is not valid: '+str(e)+'. Use days and time ranges like `fri 18:00-23:00` or `mon-fri 09:00-17:00 sat,sun 10:00-02:00 Europe/Berlin`, or `always`.')
+            return
+    found = await find_rule(responder, name)
+    if found is None: return
+    rule, prefix = found
+    if not may_change_rule(responder, rule):
+        await responder.send(content=prefix + 'This rule was found, but it mentions users other than you. '+\
+            'If a rule mentions users, it can be changed by a server manager or by the only user mentioned, if applicable.', embed=rule.as_embed())
+        return
+    await store.update_by_name(rule.name_indexes, {'schedule': new_schedule})
+    rule.schedule = new_schedule
+    await responder.send(content=prefix + ('From now on, this rule is only active during its schedule.' if new_schedule else 'From now on, this rule is always active.'), embed=rule.as_embed())
+
+async def list_rules(responder, in_entire_guild):
+    rule_list = await store.find_by_guild(responder.guild.id, None if in_entire_guild else responder.channel.id)
+    if not rule_list:
+        await responder.send('There are no rules active in this ' + ('server' if in_entire_guild else 'channel')+'.')
+        return
+    # rules disabled by the sweep are listed last, so that they can be found and deleted
+    rule_list.sort(key=lambda x: bool(x.get('disabled')))
+    active = sum(1 for i in rule_list if not i.get('disabled'))
+    rule_name_list = '\n'.join(map(lambda x: '`'+Rule(**x).name+'`'+(' (disabled, something it refers to was deleted)' if x.get('disabled') else ''), rule_list))
+    await responder.send('There are '+str(active)+' rules active in this '+('server' if in_entire_guild else 'channel') + ':\n' + rule_name_list)
+
+async def list_my_rules(responder):
+    # Every rule that mentions the author, directly or through one of their roles (including @everyone).
+    member = responder.author
+    via = {member.id: 'you'}
+    for role in member.roles:
+        via[role.id] = role.mention
+    rule_list = mention_index.rules_mentioning(responder.guild.id, list(via))
+    if rule_list is None:
+        rule_list = await store.find_by_mention(responder.guild.id, list(via))
+    rule_list = [Rule(**i) for i in rule_list if not i.get('disabled')]
+    if not rule_list:
+        await responder.send('No rules in this server mention you or your roles.')
+        return
+    lines = []
+    for rule in rule_list:
+        mentioned = [via[i.id] for i in rule.users_to_mention if i.id in via]
+        line = '`'+rule.name+'` in <#'+str(rule.channel_to_mention_id)+'>, mentioning '+', '.join(mentioned)
+        if rule.delivery == Delivery.DIGEST:
+            line += ' (summarized, without mentions)'
+        if len('\n'.join(lines + [line])) > 1800:
+            lines.append('and '+str(len(rule_list)-len(lines))+' more')
+            break
+        lines.append(line)
+    await responder.send('There are '+str(len(rule_list))+' rules that would notify you:\n'+'\n'.join(lines), allowed_mentions=discord.AllowedMentions.none())
+
+
+@bot.command(brief='Add a notification rule.',
+help='''Add a rule to send notifications on voice channel events.
+
+All parameters are optional.
+- who: user or role that performs an action, default is "everyone".
+- does_what: what action is performed, default is "joins", valid options are: ''' + ', '.join(map(lambda x: x.value, Action)) + '''.
+- in_where: name of voice channel in which the action is performed, default is "every voice channel". If this is multiple words, enclose it in "quotation marks".
+- tell_who: which users will be mentioned when the event happens.''')
+@discord.ext.commands.guild_only()
+async def add_rule(ctx,
+                   who: typing.Optional[typing.Union[discord.Member, discord.Role]]=None,
+                   does_what: typing.Optional[str]=Action.JOINS,
+                   in_where: typing.Optional[discord.VoiceChannel]=None,
+                   tell_who: discord.ext.commands.Greedy[typing.Union[discord.Member, discord.Role]]=None):
+    await create_rule(Responder(ctx=ctx), who, does_what, in_where, tell_who)
+
+@bot.command(brief='Delete an existing notification rule.',
+help='''Display and optionally delete an existing rule by name.
+To view the rules active in this channel, use the "show_rules" command.''')
+@discord.ext.commands.guild_only()
+async def del_rule(ctx, name):
+    await delete_rule(Responder(ctx=ctx), name)
+
+@bot.command(brief='Choose how a rule notifies.',
+help='''Choose whether a rule sends a notification for every event ("instant", the default)
+or periodically sends one summary of all events to its channel, without mentioning anybody ("digest").''')
+@discord.ext.commands.guild_only()
+async def set_delivery(ctx, name, delivery):
+    await change_delivery(Responder(ctx=ctx), name, delivery)
+
+@bot.command(brief='Make a rule active only at certain times.',
+help='''Make a rule active only on some days and hours, for example:
+  set_schedule rule-name fri 18:00-23:00
+  set_schedule rule-name mon-fri 09:00-17:00 sat,sun 10:00-02:00 Europe/Berlin
+Each time range applies to the days before it, or every day. Times are in UTC unless a timezone is given.
+Use "always" to remove the schedule.''')
+@discord.ext.commands.guild_only()
+async def set_schedule(ctx, name, *, schedule_text):
+    await change_schedule(Responder(ctx=ctx), name, schedule_text)
 
 
 @bot.command(brief='List rules active in this channel or server.',
@@ -462,36 +692,200 @@ help='''List the currently enabled rules in this channel or this server.
 
 By default, shows the rules in current channel. To view rules in entire server, add "yes" as an optional parameter.''')
 async def show_rules(ctx, in_entire_guild: bool=False):
-    query = {'guild': ctx.guild.id}
-    if not in_entire_guild:
-        query['channel_to_mention'] = ctx.channel.id
+    await list_rules(Responder(ctx=ctx), in_entire_guild)
 
-    rule_cursor = db.rules.find(query)
-    rule_list = await rule_cursor.to_list(None)
-    if not rule_list:
-        await ctx.send('There are no rules active in this ' + ('server' if in_entire_guild else 'channel')+'.')
-        return
-    rule_name_list = '\n'.join(map(lambda x: '`'+Rule(**x).name+'`', rule_list))
-    await ctx.send('There are '+str(len(rule_list))+' rules active in this '+('server' if in_entire_guild else 'channel') + ':\n' + rule_name_list)
+@bot.command(brief='List rules that would notify you.',
+help='''List the rules in this server that mention you, either directly or through one of your roles.''')
+@discord.ext.commands.guild_only()
+async def my_rules(ctx):
+    await list_my_rules(Responder(ctx=ctx))
+
+@bot.tree.command(name='add_rule', description='Add a rule to send notifications on voice channel events.')
+@discord.app_commands.guild_only()
+@discord.app_commands.describe(who='User or role that performs the action, default is everyone',
+                               does_what='What action is performed, default is joining',
+                               in_where='Voice channel in which the action is performed, default is every voice channel',
+                               tell_who='Who will be mentioned when the event happens',
+                               delivery='Notify for every event, or send a periodic summary without mentions')
+async def add_rule_slash(interaction: discord.Interaction,
+                         who: typing.Optional[typing.Union[discord.Member, discord.Role]]=None,
+                         does_what: Action=Action.JOINS,
+                         in_where: typing.Optional[discord.VoiceChannel]=None,
+                         tell_who: typing.Optional[typing.Union[discord.Member, discord.Role]]=None,
+                         delivery: Delivery=Delivery.INSTANT):
+    responder = Responder(interaction=interaction)
+    await responder.defer()
+    await create_rule(responder, who, does_what, in_where, [tell_who] if tell_who else None, delivery)
+
+@bot.tree.command(name='del_rule', description='Display and optionally delete an existing rule by name.')
+@discord.app_commands.guild_only()
+async def del_rule_slash(interaction: discord.Interaction, name: str):
+    responder = Responder(interaction=interaction)
+    try:
+        await responder.defer()
+        await delete_rule(responder, name)
+    except Exception as e:
+        await responder.report_error(e)
+
+@bot.tree.command(name='set_delivery', description='Choose whether a rule notifies for every event or sends a periodic summary.')
+@discord.app_commands.guild_only()
+async def set_delivery_slash(interaction: discord.Interaction, name: str, delivery: Delivery):
+    responder = Responder(interaction=interaction)
+    try:
+        await responder.defer()
+        await change_delivery(responder, name, delivery)
+    except Exception as e:
+        await responder.report_error(e)
+
+@bot.tree.command(name='set_schedule', description='Make a rule active only at certain times.')
+@discord.app_commands.guild_only()
+@discord.app_commands.describe(schedule_text='Days and time ranges like "mon-fri 18:00-23:00 Europe/Berlin", or "always"')
+async def set_schedule_slash(interaction: discord.Interaction, name: str, schedule_text: str):
+    responder = Responder(interaction=interaction)
+    try:
+        await responder.defer()
+        await change_schedule(responder, name, schedule_text)
+    except Exception as e:
+        await responder.report_error(e)
+
+@bot.tree.command(name='show_rules', description='List rules active in this channel or server.')
+@discord.app_commands.guild_only()
+async def show_rules_slash(interaction: discord.Interaction, in_entire_guild: bool=False):
+    responder = Responder(interaction=interaction)
+    try:
+        await responder.defer()
+        await list_rules(responder, in_entire_guild)
+    except Exception as e:
+        await responder.report_error(e)
+    
+@bot.tree.command(name='my_rules', description='List rules that would notify you.')
+@discord.app_commands.guild_only()
+async def my_rules_slash(interaction: discord.Interaction):
+    responder = Responder(interaction=interaction)
+    try:
+        await responder.defer()
+        await list_my_rules(responder)
+    except Exception as e:
+        await responder.report_error(e)
     
 @bot.event
 async def on_voice_state_update(member, before, after):
+    if event_recorder:
+        event_recorder.record(member.guild.id, member.id, [role.id for role in member.roles], voice.flags_from_state(before), voice.flags_from_state(after))
     try:
-        try:
-            ev = Event(user=member, state_before=before, state_after=after)
-        except ValueError: # if no handleable change occurred, ignore.
+        ev = Event(user=member, state_before=before, state_after=after)
+    except ValueError: # if no handleable change occurred, ignore.
+        return
+    if is_repeated_transition(member.guild.id, member.id, ev.transition):
+        return
+    event_scheduler.submit(member.guild.id, lambda: handle_event(ev), key=(member.guild.id, member.id))
+
+@bot.event
+async def on_classified_voice_event(ev):
+    event_scheduler.submit(ev.user.guild.id, lambda: handle_event(ev), key=(ev.user.guild.id, ev.user.id))
+
+EVENT_DEDUP_WINDOW = float(os.getenv('EVENT_DEDUP_WINDOW') or 300)
+EVENT_DEDUP_SHARED = (os.getenv('EVENT_DEDUP_SHARED') or 'no') == 'yes'
+EVENT_DEDUP_CLAIM_TTL = float(os.getenv('EVENT_DEDUP_CLAIM_TTL') or 10)
+recent_events = voice.RecentEvents(int(os.getenv('EVENT_DEDUP_SIZE') or 10000), EVENT_DEDUP_WINDOW) if EVENT_DEDUP_WINDOW else None
+# fingerprint -> how often it was claimed recently. Real repeats (join, leave, join in one voice session) get the same
+# fingerprint; numbering them gives each its own claim, and every process that sees the same events numbers them alike.
+# Kept longer than the claims themselves, so that a number is never reused while its claim may still exist.
+claimed_fingerprints = cache.LRUCache(int(os.getenv('EVENT_DEDUP_SIZE') or 10000), ttl=2 * EVENT_DEDUP_CLAIM_TTL)
+duplicate_events = 0
+
+def is_repeated_transition(guild_id, user_id, transition):
+    # Must see every classified transition of a member, in the order they arrive, before anything filters them out.
+    global duplicate_events
+    if recent_events is None or transition is None or recent_events.first_time(guild_id, user_id, transition):
+        return False
+    duplicate_events += 1
+    log.info('dropped repeated voice event', extra={'fields': {'guild': guild_id, 'user': user_id, 'transition': repr(transition)}})
+    return True
+
+async def handle_event(ev, now=None):
+    # `now` is for replaying recorded events at the time they happened.
+    global duplicate_events
+    try:
+        if not rule_index.might_match(ev.user.guild.id, ev.user.id, [role.id for role in ev.user.roles], ev.action, ev.channel.id):
             return
 
-        rules = await ev.lookup_rules()
+        started = time.perf_counter()
+        rules = await ev.lookup_rules(now)
+        if rules and EVENT_DEDUP_SHARED and ev.transition is not None:
+            # only events that are about to notify are claimed, so most events never cost a database call
+            fingerprint = voice.transition_fingerprint(ev.user.guild.id, ev.user.id, ev.transition)
+            repeat = claimed_fingerprints.get(fingerprint, 0) + 1
+            claimed_fingerprints.put(fingerprint, repeat)
+            fingerprint += ':' + str(repeat)
+            if not await store.claim_event(fingerprint, EVENT_DEDUP_CLAIM_TTL):
+                duplicate_events += 1
+                log.info('dropped voice event claimed by another process', extra={'fields': {'guild': ev.user.guild.id, 'user': ev.user.id, 'fingerprint': fingerprint}})
+                rules = []
         if rules:
-            if len(rules)==1:
-                await rules[0].send_notification(ev)
-            else:
-                await Rule.send_notifications_for_list(ev, rules)
+            sending = time.perf_counter()
+            await send_notifications(ev, rules)
+            profiling.timings.observe('handle_event.notify', time.perf_counter() - sending)
+        profiling.timings.observe('handle_event', time.perf_counter() - started)
 
         #await member.send('You just caused this event: '+repr(ev))
     except Exception as e:
-        await on_command_error(None, e, guild=member.guild)
+        await on_command_error(None, e, guild=ev.user.guild)
+
+# For offline replay with replay.py
+event_recorder = recording.EventRecorder(os.getenv('RECORD_VOICE_EVENTS')) if os.getenv('RECORD_VOICE_EVENTS') else None
+
+RAW_VOICE_FAST_PATH = (os.getenv('RAW_VOICE_FAST_PATH') or 'no') == 'yes'
+voice_states = voice.VoiceStateMap()
+
+def install_voice_fast_path():
+    # Replaces discord.py's VOICE_STATE_UPDATE parser (there is no public hook for this) with one that classifies
+    # the raw payload against our own compact voice state map and the rule index,
+    # and only builds Member and channel models for events that may actually cause a notification.
+    # discord.py's own voice state cache is then only kept for the bot itself, which voice connections need.
+    connection = bot._connection
+    original_parser = connection.parsers['VOICE_STATE_UPDATE']
+
+    def parse_voice_state_update(data):
+        guild_id = data.get('guild_id')
+        user_id = int(data['user_id'])
+        if guild_id is None or user_id == connection.self_id:
+            return original_parser(data)
+        guild_id = int(guild_id)
+
+        after = voice.flags_from_payload(data)
+        before = voice_states.swap(guild_id, user_id, after)
+        member_data = data.get('member') or {}
+        role_ids = [int(i) for i in member_data.get('roles', [])] + [guild_id]  # the @everyone role has the guild's ID
+        if event_recorder:
+            event_recorder.record(guild_id, user_id, role_ids, before, after)
+        action = voice.classify(before, after)
+        if action is None: return
+        transition = (before, after, data.get('session_id'))
+        if is_repeated_transition(guild_id, user_id, transition): return
+
+        channel_id = before.channel_id or after.channel_id
+        if not rule_index.might_match(guild_id, user_id, role_ids, action, channel_id): return
+
+        guild = bot.get_guild(guild_id)
+        if guild is None or not member_data: return
+        member = guild.get_member(user_id) or discord.Member(data=member_data, guild=guild, state=connection)
+        channel = guild.get_channel(channel_id)
+        if channel is None: return
+        bot.dispatch('classified_voice_event', Event.from_action(member, action, channel, transition))
+
+    connection.parsers['VOICE_STATE_UPDATE'] = parse_voice_state_update
+
+@bot.event
+async def on_guild_available(guild):
+    if RAW_VOICE_FAST_PATH:
+        voice_states.seed(guild)
+
+@bot.event
+async def on_guild_join(guild):
+    await store.load_guild(guild.id)
+    if RAW_VOICE_FAST_PATH:
+        voice_states.seed(guild)
 
 @add_rule.error
 @bot.event
@@ -503,42 +897,217 @@ async def on_command_error(ctx, exception, guild=None):
     if isinstance(exception, pymongo.errors.OperationFailure):  # this traceback is too long for an embed.
         emb.description = '```'+repr(exception)+'```'
     else:
-        emb.description = '```\n'+''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))+'\n```'
+        emb.description = '```\n'+''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))[-1900:]+'\n```'
 
+    # Reports are deduplicated by fingerprint and rate-limited per guild, then sent either to the invoking channel
+    # or to a reporting channel that was found once with local permission checks.
+    # Everything, including reports that were dropped, goes to the structured log.
+    return await reporter.report(exception, emb, guild=guild, ctx=ctx)
 
-    # Try to send this anywhere we can.
-    # First, use the default context.
-    # If that fails, or the context is not available (for example from custom invocations), then try the guild's system notifications channel.
-    # If that also fails, try every channel on the guild in order, continuing to the next one for every failure.
-    # If all of this fails, we ignore the exception.
+@bot.event
+async def on_guild_channel_create(channel):
+    reporter.forget_guild(channel.guild.id)
 
-    if ctx:
-        try:
-            await ctx.send(embed=emb)
-            return True
-        except discord.Forbidden: pass
-        if not guild: guild = ctx.guild
-    if not guild: return False
-    if guild.system_channel:
+@bot.event
+async def on_guild_channel_update(before, after):
+    permission_cache.forget_channel(after)
+    reporter.forget_guild(after.guild.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    permission_cache.forget_channel(channel)
+    reporter.forget_guild(channel.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    permission_cache.forget_guild(after.guild.id)
+    reporter.forget_guild(after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    permission_cache.forget_guild(role.guild.id)
+    reporter.forget_guild(role.guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    permission_cache.forget_guild(after.id)
+    reporter.forget_guild(after.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    store.drop_guild(guild.id)
+    voice_states.forget_guild(guild.id)
+    permission_cache.forget_guild(guild.id)
+    reporter.forget_guild(guild.id)
+    model_resolver.forget_guild(guild.id)
+
+RULE_SWEEP_ACTION = os.getenv('RULE_SWEEP_ACTION') or 'disable'
+
+@tasks.loop(seconds=int(os.getenv('RULE_SWEEP_INTERVAL') or 3600))
+async def sweep_rules():
+    # Find rules that point to deleted channels, roles or members, and disable or delete them all in one batch,
+    # so that we stop trying to hydrate them and send notifications for them.
+    # Rules for guilds we cannot see right now are left alone, because the guild may just be unavailable.
+    try:
+        broken = dict()
+        for guild in bot.guilds:
+            if guild.unavailable: continue
+            rule_list = [Rule(**doc) for doc in await store.find_by_guild(guild.id) if not doc.get('disabled')]
+            # look up every member these rules refer to in a few batched requests, instead of one request per member
+            await model_resolver.members_by_id(guild, [i for rule in rule_list for i in rule.member_ids()])
+            for rule in rule_list:
+                missing = await rule.missing_references()
+                if missing:
+                    broken[rule.name] = (rule.name_indexes, missing)
+        if not broken: return
+
+        if RULE_SWEEP_ACTION == 'delete':
+            await store.delete_many_by_name([indexes for indexes, _ in broken.values()])
+        else:
+            await store.disable_many(list(broken.values()))
+        log.info('swept broken rules', extra={'fields': {'action': RULE_SWEEP_ACTION, 'rules': {name: missing for name, (_, missing) in broken.items()}}})
+    except Exception:
+        log.exception('rule sweep failed')
+
+@tasks.loop(seconds=int(os.getenv('STORE_SNAPSHOT_INTERVAL') or 300))
+async def refresh_rule_snapshot():
+    # This also acts as the probe that closes the circuit again when the database recovers.
+    await store.refresh_snapshot()
+    if store.pending_writes:
+        await store.replay_writes()
+
+DIGEST_INTERVAL = int(os.getenv('DIGEST_INTERVAL') or 3600)
+DIGEST_STATE_PATH = os.getenv('DIGEST_STATE_PATH') or 'digest-counters.json'
+digest_counters = digest.DigestCounters()
+
+def save_digest_counters():
+    # Counts that were not summarized yet. The file always holds exactly what is still to be sent,
+    # so that after an unclean exit, summaries that were already sent are not sent again.
+    try:
+        digest_counters.save(DIGEST_STATE_PATH)
+    except OSError:
+        log.exception('could not save digest counters')
+
+@tasks.loop(seconds=DIGEST_INTERVAL)
+async def flush_digests():
+    # One summary message per destination channel, instead of one message per event.
+    for destination_id, entry in digest_counters.pop_all().items():
+        channel = bot.get_channel(destination_id)
+        if channel is None: continue  # the channel was deleted
+        if not permission_cache.can_send(channel):
+            log.info('skipping digest, cannot send to destination', extra={'fields': {'rules': entry['rules'], 'channel': destination_id}})
+            continue
+        emb = discord.Embed()
+        emb.timestamp = datetime.datetime.now()
+        emb.description = 'This summary was created by ' + ('rule ' if len(entry['rules']) == 1 else 'these rules: ') + ', '.join('`'+i+'`' for i in entry['rules']) + '.'
+        period = max(DIGEST_INTERVAL, time.time() - entry['since'])
         try:
-            await guild.system_channel.send(embed=emb)
-            return True
+            await channel.send(content=digest.summary_text(entry, period), embed=emb, allowed_mentions=discord.AllowedMentions.none())
         except discord.Forbidden:
-            pass
-        for chan in guild.channels:
-            try:
-                await chan.send(embed=emb)
-                return True
-            except discord.Forbidden:
-                pass
-        
-
-    return False
+            permission_cache.forget_channel(channel)
+        except (discord.HTTPException, asyncio.TimeoutError):
+            digest_counters.restore(destination_id, entry)  # try again next time
+            log.warning('could not send digest', exc_info=True, extra={'fields': {'channel': destination_id}})
+    save_digest_counters()
+
+@bot.command(brief='Show the health of the rule database.', hidden=True,
+help='''Show whether the rule database is reachable.
+
+While it is not, rules are served from a recent in-memory copy, and changes to rules are applied once the database is back.''')
+@commands.is_owner()  # the last error may name the database host
+async def db_health(ctx):
+    health = store.health
+    emb = discord.Embed()
+    emb.title = 'Rule database is ' + health['state']
+    emb.color = discord.Color.green() if health['state'] == 'healthy' else discord.Color.orange()
+    for key, value in health.items():
+        if key == 'state' or value is None: continue
+        emb.add_field(name=key.replace('_', ' ').capitalize(), value=str(value))
+    await ctx.send(embed=emb)
+
+@bot.command(brief='Show memory usage.', hidden=True)
+@commands.is_owner()
+async def memory_stats(ctx):
+    rss = cache.resident_memory()
+    guild_count = len(bot.guilds) or 1
+    emb = discord.Embed()
+    emb.title = 'Memory usage' + (' (low-memory mode)' if LOW_MEMORY_MODE else '')
+    emb.add_field(name='RSS', value=str(round(rss / 2**20, 1)) + ' MiB')
+    emb.add_field(name='RSS per guild', value=str(round(rss / guild_count / 2**10, 1)) + ' KiB')
+    emb.add_field(name='Guilds', value=str(len(bot.guilds)))
+    emb.add_field(name='Cached members', value=str(sum(len(g.members) for g in bot.guilds)))
+    emb.add_field(name='Cached users', value=str(len(bot.users)))
+    emb.add_field(name='Fetched members', value=str(len(fetched_members)) + ' (' + str(fetched_members.hits) + ' hits, ' + str(fetched_members.misses) + ' misses, ' + str(model_resolver.queries) + ' requests)')
+    await ctx.send(embed=emb)
+
+@bot.command(brief='Show the voice event backlog.', hidden=True)
+@commands.is_owner()
+async def queue_stats(ctx):
+    stats = event_scheduler.stats()
+    lines = ['Queued: '+str(stats['queued'])+', running: '+str(stats['in_flight'])+', guilds waiting: '+str(stats['guilds_waiting'])+', dropped: '+str(stats['dropped'])+', duplicates: '+str(duplicate_events)]
+    for guild in stats['guilds']:
+        lines.append('`'+str(guild['guild'])+'`: '+str(guild['queued'])+' queued, '+str(guild['in_flight'])+' running, longest wait '+str(guild['max_wait'])+'s, '+str(guild['dropped'])+' dropped')
+    await ctx.send('\n'.join(lines))
+
+loop_monitor = profiling.LoopMonitor(lag_threshold=float(os.getenv('LOOP_LAG_THRESHOLD_MS') or 100) / 1000,
+                                     slow_callback=float(os.getenv('SLOW_CALLBACK_MS')) / 1000 if os.getenv('SLOW_CALLBACK_MS') else None)
+
+@bot.command(brief='Profile the bot for a number of seconds.', hidden=True)
+@commands.is_owner()
+async def profile(ctx, seconds: float=10):
+    seconds = profiling.profile_seconds(seconds)
+    await ctx.send('Profiling for '+str(seconds)+' seconds...')
+    try:
+        report = await profiling.profile_for(seconds)
+    except RuntimeError as e:
+        await ctx.send(str(e))
+        return
+    await ctx.send(content=loop_monitor.report(), file=discord.File(io.BytesIO(report.encode()), filename='profile.txt'))
+
+@bot.command(brief='Show event loop lag and where time is spent.', hidden=True)
+@commands.is_owner()
+async def loop_stats(ctx, reset: bool=False):
+    report = loop_monitor.report() + '\n\n' + profiling.timings.report(reset=reset)
+    if len(report) > 1900:
+        await ctx.send(file=discord.File(io.BytesIO(report.encode()), filename='loop_stats.txt'))
+    else:
+        await ctx.send('```\n'+report+'\n```')
 
-async def cannot_add_reactions(ctx):
-    await ctx.send('This bot cannot add reactions to messages. Please allow this bot the "Add Reactions" permission.')
+@bot.event
+async def setup_hook():
+    event_scheduler.start()
+    loop_monitor.start()
+    if os.getenv('ADMIN_SOCKET'):
+        await profiling.serve_admin_socket(os.getenv('ADMIN_SOCKET'), loop_monitor)
+    if RAW_VOICE_FAST_PATH:
+        install_voice_fast_path()
+    digest_counters.load(DIGEST_STATE_PATH)
+    # `docker stop` sends SIGTERM; close the bot so that bot.run returns and the shutdown code below still runs
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    except NotImplementedError:  # Windows
+        pass
+    # slash commands are global, so only one process needs to register them
+    if (os.getenv('SYNC_APP_COMMANDS') or 'yes') == 'yes' and (SHARD_IDS is None or 0 in SHARD_IDS):
+        await bot.tree.sync()
 
-async def cannot_clear_reactions(ctx):
-    await ctx.send('This bot cannot remove reactions on messages. Please allow this bot the "Manage Messages" permission.')
+store_ready = False
 
-bot.run(TOKEN)
+@bot.event
+async def on_ready():
+    global store_ready
+    if not store_ready:
+        await store.setup()
+        store_ready = True
+    if not refresh_rule_snapshot.is_running():
+        refresh_rule_snapshot.start()
+    if not sweep_rules.is_running():
+        sweep_rules.start()
+    if not flush_digests.is_running():
+        flush_digests.start()
+
+if __name__ == '__main__':
+    bot.run(TOKEN)
+    if event_recorder:
+        event_recorder.close()
+    save_digest_counters()
@@ -0,0 +1,36 @@
+import discord
+
+import time
+
+
+class PermissionCache:
+    # Caches the bot's own permissions per channel, so that we can check locally whether a send
+    # can succeed before making the API call.
+    # Must be invalidated whenever channel overwrites or roles change. Changes to the bot's own roles are not
+    # delivered without the members intent, so permissions that deny sending are only trusted for `denied_ttl` seconds;
+    # permissions that allow sending are corrected by the 403 when they are stale.
+    def __init__(self, denied_ttl=60):
+        self.denied_ttl = denied_ttl
+        self.by_guild = dict()  # guild id -> {channel id -> (discord.Permissions, expiry time or None)}
+
+    def permissions(self, channel):
+        guild_cache = self.by_guild.setdefault(channel.guild.id, dict())
+        perms, expires_at = guild_cache.get(channel.id, (None, None))
+        if perms is None or (expires_at is not None and expires_at <= time.monotonic()):
+            perms = channel.permissions_for(channel.guild.me)
+            denied = not (perms.view_channel and perms.send_messages and perms.embed_links)
+            guild_cache[channel.id] = (perms, time.monotonic() + self.denied_ttl if denied else None)
+        return perms
+
+    def can_send(self, channel, *, embed=True):
+        if channel is None: return False
+        if not isinstance(channel, discord.abc.GuildChannel): return True  # DMs are not permission-checked
+        if channel.guild.me is None: return False
+        perms = self.permissions(channel)
+        return perms.view_channel and perms.send_messages and (perms.embed_links or not embed)
+
+    def forget_channel(self, channel):
+        self.by_guild.get(channel.guild.id, dict()).pop(channel.id, None)
+
+    def forget_guild(self, guild_id):
+        self.by_guild.pop(guild_id, None)
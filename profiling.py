@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+log = logging.getLogger('notifier.profiling')
+
+
+class Timings:
+    # Count, total and maximum duration per named section, like 'store.lookup'.
+    def __init__(self):
+        self.sections = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def observe(self, name, seconds):
+        section = self.sections[name]
+        section[0] += 1
+        section[1] += seconds
+        if seconds > section[2]:
+            section[2] = seconds
+
+    def report(self, reset=False):
+        lines = []
+        for name, (count, total, longest) in sorted(self.sections.items(), key=lambda i: i[1][1], reverse=True):
+            lines.append(name + ': ' + str(count) + ' calls, ' + str(round(total * 1000 / count, 2)) + ' ms average, ' + str(round(longest * 1000, 2)) + ' ms max')
+        if reset:
+            self.sections.clear()
+        return '\n'.join(lines) or 'Nothing timed yet.'
+
+
+timings = Timings()
+
+
+def describe_callback(handle):
+    # Names the coroutine behind a task step, which is what almost every slow callback is.
+    callback = handle._callback
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        frame = getattr(coro, 'cr_frame', None)
+        return getattr(coro, '__qualname__', repr(coro)) + (':' + str(frame.f_lineno) if frame else '')
+    return getattr(callback, '__qualname__', repr(callback))
+
+
+class LoopMonitor:
+    # Measures event loop lag by checking how late a periodic wakeup is, and logs every callback that
+    # blocked the loop for longer than `slow_callback` seconds, with the coroutine it belonged to.
+    # Timing callbacks wraps a private asyncio method for the whole process, so it is off unless `slow_callback` is set.
+    def __init__(self, *, interval=0.5, lag_threshold=0.1, slow_callback=None):
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.slow_callback = slow_callback
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_callbacks = collections.Counter()  # description -> times it was slow
+        self.task = None
+        self.original_run = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._watch_lag())
+        if self.slow_callback and self.original_run is None:
+            self._hook_callbacks()
+
+    def _hook_callbacks(self):
+        # asyncio's debug mode can do this too, but it also turns on expensive checks everywhere else.
+        monitor = self
+        original_run = self.original_run = asyncio.events.Handle._run
+
+        def timed_run(handle):
+            started = time.perf_counter()
+            try:
+                return original_run(handle)
+            finally:
+                duration = time.perf_counter() - started
+                if duration >= monitor.slow_callback:
+                    monitor.report_slow(handle, duration)
+
+        asyncio.events.Handle._run = timed_run
+
+    def report_slow(self, handle, duration):
+        description = describe_callback(handle)
+        self.slow_callbacks[description] += 1
+        timings.observe('slow callback ' + description, duration)
+        log.warning('slow callback', extra={'fields': {'callback': description, 'ms': round(duration * 1000, 1)}})
+
+    async def _watch_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag >= self.lag_threshold:
+                log.warning('event loop lag', extra={'fields': {'ms': round(self.last_lag * 1000, 1)}})
+
+    def report(self):
+        lines = ['Loop lag: ' + str(round(self.last_lag * 1000, 1)) + ' ms now, ' + str(round(self.max_lag * 1000, 1)) + ' ms max']
+        for description, count in self.slow_callbacks.most_common(10):
+            lines.append('Slow: ' + description + ' (' + str(count) + ' times)')
+        return '\n'.join(lines)
+
+
+profile_lock = None
+
+
+def profile_seconds(seconds):
+    # Profiling slows everything down, so sessions last at least one second and at most two minutes.
+    return min(seconds, 120) if seconds >= 1 else 1  # also turns NaN into 1
+
+
+async def profile_for(seconds, top=40):
+    # Profiles everything that runs on the event loop thread for `seconds`, and returns the report as text.
+    global profile_lock
+    if profile_lock is None:
+        profile_lock = asyncio.Lock()
+    if profile_lock.locked():
+        raise RuntimeError('A profiling session is already running.')
+    async with profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('tottime').print_stats(top)
+    stats.sort_stats('cumulative').print_stats(top)
+    return output.getvalue()
+
+
+async def serve_admin_socket(path, monitor):
+    # A local control socket, for when Discord itself is too slow to use. One command per connection:
+    #   profile SECONDS | lag | timings
+    async def handle(reader, writer):
+        try:
+            command = (await reader.readline()).decode().split()
+            if command[:1] == ['profile']:
+                response = await profile_for(profile_seconds(float(command[1]) if len(command) > 1 else 10))
+            elif command[:1] == ['lag']:
+                response = monitor.report()
+            elif command[:1] == ['timings']:
+                response = timings.report()
+            else:
+                response = 'Commands: profile SECONDS, lag, timings'
+        except Exception as e:
+            response = 'Error: ' + repr(e)
+        writer.write(response.encode() + b'\n')
+        await writer.drain()
+        writer.close()
+
+    # created without permissions for others, instead of being open until a chmod after binding
+    umask = os.umask(0o077)
+    try:
+        server = await asyncio.start_unix_server(handle, path=path)
+    finally:
+        os.umask(umask)
+    return server
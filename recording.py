@@ -0,0 +1,42 @@
+import voice
+
+import json
+import time
+
+# Recorded voice state updates are stored one per line as a compact JSON array:
+# [time, guild id, user id, [role ids], before flags, after flags]
+# where flags are [channel id, deaf, mute, stream] like voice.VoiceFlags.
+
+
+class EventRecorder:
+    # Appends voice state updates to a file. Writes are buffered in memory and flushed every `flush_every` records,
+    # so recording does not touch the disk on every event.
+    def __init__(self, path, flush_every=100):
+        self.file = open(path, 'a', buffering=1 << 16)
+        self.flush_every = flush_every
+        self.unflushed = 0
+        self.recorded = 0
+
+    def record(self, guild_id, user_id, role_ids, before, after, at=None):
+        self.file.write(json.dumps([round(at or time.time(), 3), guild_id, user_id, list(role_ids), list(before), list(after)], separators=(',', ':')))
+        self.file.write('\n')
+        self.recorded += 1
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.file.close()
+
+
+def read_events(path):
+    # Yields (time, guild id, user id, role ids, before VoiceFlags, after VoiceFlags).
+    with open(path) as file:
+        for line in file:
+            if not line.strip(): continue
+            at, guild_id, user_id, role_ids, before, after = json.loads(line)
+            yield at, guild_id, user_id, role_ids, voice.VoiceFlags(*before), voice.VoiceFlags(*after)
@@ -0,0 +1,147 @@
+# Replays voice state updates recorded with RECORD_VOICE_EVENTS through the bot's own classification, deduplication
+# and `handle_event`, with a stub dispatcher instead of Discord, and reports throughput and latency.
+#
+#   python3 replay.py events.jsonl --rules rules.jsonl --speed 10
+#
+# rules.jsonl holds one rule document per line, as stored in the database (for example from mongoexport).
+# Unless RULE_STORE is set, rules are loaded into an in-memory store, so no database or network is needed.
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import time
+import types
+
+os.environ.setdefault('RULE_STORE', 'memory')
+
+import dispatch
+import main
+import profiling
+import recording
+import voice
+
+
+class StubDispatcher:
+    # Plans the messages like the bot would, and counts them instead of sending them.
+    def __init__(self):
+        self.matched = 0
+        self.notifications = 0
+        self.digested = 0
+        self.messages = 0
+        self.by_channel = collections.Counter()
+
+    async def dispatch(self, ev, rules):
+        self.matched += 1
+        digest_rules = [i for i in rules if i.delivery == main.Delivery.DIGEST]
+        self.digested += len(digest_rules)  # only counted, summaries are sent once per interval
+        rules = [i for i in rules if i.delivery != main.Delivery.DIGEST]
+        self.notifications += len(rules)
+        for planned in dispatch.plan(rules, main.ACTION_MESSAGES[ev.action].format(user=ev.user.id, channel=ev.channel.id)):
+            self.messages += 1
+            self.by_channel[planned.channel_id] += 1
+
+
+def percentile(values, fraction):
+    if not values: return None
+    return values[min(len(values)-1, int(len(values) * fraction))]
+
+
+async def load_rules(path):
+    main.store.scope = None  # we are not connected, so we have no guilds to limit the snapshot to
+    await main.store.setup()
+    count = 0
+    with open(path) as file:
+        for line in file:
+            if not line.strip(): continue
+            doc = json.loads(line)
+            doc.pop('_id', None)
+            await main.store.inner.insert(doc)
+            count += 1
+    await main.store.refresh_snapshot()
+    return count
+
+
+async def raise_error(ctx, exception, guild=None):
+    # instead of reporting errors to Discord
+    raise exception
+
+
+async def process(record, scheduled, counters, latencies):
+    at, guild_id, user_id, role_ids, before, after = record
+    action = voice.classify(before, after)
+    counters['events'] += 1
+    if action is not None:
+        counters['classified'] += 1
+        transition = (before, after, None)  # the voice session ID is not recorded
+        if main.is_repeated_transition(guild_id, user_id, transition):
+            counters['repeated'] += 1
+        else:
+            guild = types.SimpleNamespace(id=guild_id)
+            user = types.SimpleNamespace(id=user_id, guild=guild, roles=[types.SimpleNamespace(id=i) for i in role_ids])
+            ev = main.Event.from_action(user, action, types.SimpleNamespace(id=before.channel_id or after.channel_id), transition)
+            await main.handle_event(ev, datetime.datetime.fromtimestamp(at, datetime.timezone.utc))
+    latencies.append(time.perf_counter() - scheduled)
+
+
+async def replay(path, speed, dispatcher):
+    main.send_notifications = dispatcher.dispatch
+    main.on_command_error = raise_error
+    # With speed 0, events are processed one after another as fast as possible.
+    # Otherwise they are started at their recorded times divided by `speed`, and may overlap like in production;
+    # latency is then measured from when the event should have arrived.
+    counters = collections.Counter()
+    latencies = []
+    tasks = []
+    first_at = None
+    start = time.perf_counter()
+    for record in recording.read_events(path):
+        if first_at is None: first_at = record[0]
+        if speed:
+            scheduled = start + (record[0] - first_at) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(process(record, scheduled, counters, latencies)))
+        else:
+            await process(record, time.perf_counter(), counters, latencies)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {'events': counters['events'],
+            'classified': counters['classified'],
+            'repeated': counters['repeated'],
+            'lookups': profiling.timings.sections['store.lookup'][0],
+            'matched': dispatcher.matched,
+            'notifications': dispatcher.notifications,
+            'digested': dispatcher.digested,
+            'messages': dispatcher.messages,
+            'seconds': round(elapsed, 3),
+            'events_per_second': round(counters['events'] / elapsed, 1) if elapsed else None,
+            'latency_ms': {name: round(value * 1000, 3) if value is not None else None
+                           for name, value in [('p50', percentile(latencies, 0.5)), ('p90', percentile(latencies, 0.9)),
+                                               ('p99', percentile(latencies, 0.99)), ('max', latencies[-1] if latencies else None)]}}
+
+
+async def run(args):
+    rule_count = await load_rules(args.rules) if args.rules else 0
+    result = await replay(args.events, args.speed, StubDispatcher())
+    result['rules'] = rule_count
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key, value in result.items():
+            print(key + ':', value)
+    await main.store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded voice state updates without connecting to Discord.')
+    parser.add_argument('events', help='file recorded with RECORD_VOICE_EVENTS')
+    parser.add_argument('--rules', help='file with one rule document per line')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed relative to the recording, 0 for as fast as possible')
+    parser.add_argument('--json', action='store_true', help='print the results as one JSON object, for comparing versions')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,147 @@
+import discord
+
+import collections
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import time
+import traceback
+
+log = logging.getLogger('notifier')
+
+
+class StructuredFormatter(logging.Formatter):
+    # One JSON object per line; extra fields are passed as `extra={'fields': {...}}`.
+    def format(self, record):
+        entry = {'ts': round(record.created, 3),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level=logging.INFO):
+    # Records are formatted in the calling thread (cheap) and written out by a listener thread,
+    # so a slow stdout never blocks the event loop.
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(StructuredFormatter())
+    sink = logging.StreamHandler()
+    sink.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, sink)
+    log.addHandler(queue_handler)
+    log.setLevel(level)
+    log.propagate = False
+    listener.start()
+    return listener
+
+
+def fingerprint(exception):
+    # Errors are considered the same if they have the same type and were raised from the same place.
+    frames = traceback.extract_tb(exception.__traceback__)
+    site = frames[-1] if frames else None
+    key = type(exception).__module__ + '.' + type(exception).__qualname__
+    if site:
+        key += '@' + site.filename + ':' + str(site.lineno)
+    return hashlib.sha1(bytes(key, 'utf8')).hexdigest()[:12]
+
+
+class ErrorReporter:
+    def __init__(self, permission_cache, *, dedup_window=300, reports_per_guild=3, report_period=60, max_fingerprints=4096):
+        self.permission_cache = permission_cache
+        self.dedup_window = dedup_window
+        self.reports_per_guild = reports_per_guild
+        self.report_period = report_period
+        self.max_fingerprints = max_fingerprints
+        self.last_reported = collections.OrderedDict()  # (guild id, fingerprint) -> time of last report
+        self.suppressed = collections.Counter()  # (guild id, fingerprint) -> reports dropped since last one
+        self.recent_reports = dict()  # guild id -> deque of report times
+        self.report_channels = dict()  # guild id -> channel or None, found once with local permission checks
+
+    def should_report(self, guild_id, fp, now=None):
+        now = now or time.monotonic()
+        key = (guild_id, fp)
+        last = self.last_reported.get(key)
+        if last is not None and now - last < self.dedup_window:
+            self.suppressed[key] += 1
+            return False
+
+        recent = self.recent_reports.setdefault(guild_id, collections.deque())
+        while recent and now - recent[0] >= self.report_period:
+            recent.popleft()
+        if len(recent) >= self.reports_per_guild:
+            self.suppressed[key] += 1
+            return False
+
+        recent.append(now)
+        self.last_reported[key] = now
+        self.last_reported.move_to_end(key)
+        while len(self.last_reported) > self.max_fingerprints:
+            old_key, _ = self.last_reported.popitem(last=False)
+            self.suppressed.pop(old_key, None)
+        return True
+
+    def pop_suppressed(self, guild_id, fp):
+        return self.suppressed.pop((guild_id, fp), 0)
+
+    def can_report_in(self, channel):
+        return isinstance(channel, discord.TextChannel) and self.permission_cache.can_send(channel)
+
+    def report_channel(self, guild):
+        if guild.id in self.report_channels:
+            return self.report_channels[guild.id]
+        channel = None
+        candidates = [guild.system_channel] + sorted(guild.text_channels, key=lambda c: c.position)
+        for candidate in candidates:
+            if candidate is not None and self.can_report_in(candidate):
+                channel = candidate
+                break
+        if channel is not None:  # otherwise look again next time, the bot may have been given permissions since
+            self.report_channels[guild.id] = channel
+        return channel
+
+    def forget_guild(self, guild_id):
+        self.report_channels.pop(guild_id, None)
+
+    async def report(self, exception, embed, *, guild=None, ctx=None):
+        guild = guild or (ctx.guild if ctx else None)
+        guild_id = guild.id if guild else None
+        fp = fingerprint(exception)
+        fields = {'fingerprint': fp, 'guild': guild_id, 'error': repr(exception),
+                  'command': ctx.command.qualified_name if ctx and ctx.command else None}
+        log.error('unhandled error', exc_info=(type(exception), exception, exception.__traceback__),
+                  extra={'fields': fields})
+
+        if guild is None and ctx is None: return False
+        if not self.should_report(guild_id, fp): return False
+        repeats = self.pop_suppressed(guild_id, fp)
+        if repeats:
+            embed.set_footer(text='This error also happened '+str(repeats)+' more times that were not reported. Error ID: '+fp)
+        else:
+            embed.set_footer(text='Error ID: '+fp)
+
+        # The invoking channel is the most useful place for command errors, if we are allowed to write there.
+        destinations = []
+        if ctx and (ctx.guild is None or self.can_report_in(ctx.channel)):
+            destinations.append(ctx.channel)
+        if guild:
+            channel = self.report_channel(guild)
+            if channel is not None and channel not in destinations:
+                destinations.append(channel)
+
+        for channel in destinations:
+            try:
+                await channel.send(embed=embed)
+                return True
+            except discord.Forbidden:
+                if guild and self.report_channels.get(guild.id) == channel:
+                    self.forget_guild(guild.id)
+            except discord.HTTPException:
+                log.warning('could not deliver error report', exc_info=True,
+                            extra={'fields': {'fingerprint': fp, 'guild': guild_id, 'channel': channel.id}})
+        return False
@@ -0,0 +1,290 @@
+import profiling
+import storage
+
+import asyncio
+import collections
+import enum
+import logging
+import time
+
+log = logging.getLogger('notifier.store')
+
+
+class CircuitState(enum.Enum):
+    CLOSED = 'closed'  # the database is healthy
+    OPEN = 'open'  # the database is failing, nothing is sent to it
+    HALF_OPEN = 'half-open'  # trying a single call to see whether the database recovered
+
+
+class CircuitBreaker:
+    def __init__(self, *, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.state == CircuitState.CLOSED: return True
+        if self.state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = CircuitState.HALF_OPEN
+        if self.state == CircuitState.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        recovered = self.state != CircuitState.CLOSED
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.probing = False
+        return recovered
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != CircuitState.OPEN:
+                log.warning('rule store circuit opened', extra={'fields': {'failures': self.failures}})
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+
+
+class StoreUnavailable(Exception):
+    pass
+
+
+class ResilientRuleStore(storage.RuleStore):
+    # Wraps another store with bounded timeouts and a circuit breaker.
+    # Reads that cannot be served by the database are answered from the last-known-good snapshot of all rules,
+    # and writes are applied to the snapshot and queued, to be replayed once the database is back.
+    def __init__(self, inner, *, timeout=2.0, snapshot_timeout=30.0, failure_threshold=3, reset_timeout=30, scope=None):
+        self.inner = inner
+        self.scope = scope  # if set, returns the IDs of the guilds whose rules should be in the snapshot
+        self.timeout = timeout
+        self.snapshot_timeout = snapshot_timeout  # loading all rules takes longer than the lookups on the hot path
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.snapshot = dict()  # guild id -> {name (tuple of indexes) -> rule document}
+        self.snapshot_loaded_at = None
+        self.pending_writes = []  # (method name, args), in order
+        self.dead_letters = collections.deque(maxlen=100)  # (method name, args, error) of queued writes that the database rejected
+        self.last_error = None
+        self.replay_lock = None  # created on first use, so that it belongs to the running event loop
+        self.listeners = []  # called with a guild ID (or None for all guilds) whenever the snapshot changes
+
+    def _changed(self, guild_id=None):
+        for listener in self.listeners:
+            listener(guild_id)
+
+    async def _call(self, method, *args, timeout=None):
+        if not self.breaker.allow():
+            raise StoreUnavailable('circuit is ' + self.breaker.state.value)
+        probe = self.breaker.state == CircuitState.HALF_OPEN
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(getattr(self.inner, method)(*args), timeout or self.timeout)
+        except (asyncio.TimeoutError,) + tuple(self.inner.connection_errors) as e:
+            profiling.timings.observe('store.' + method + ' (failed)', time.perf_counter() - started)
+            self.last_error = repr(e)
+            self.breaker.record_failure()
+            log.warning('rule store call failed', extra={'fields': {'method': method, 'error': repr(e), 'circuit': self.breaker.state.value}})
+            raise StoreUnavailable(repr(e)) from e
+        except Exception:
+            # the database answered, but rejected the request (or we have a bug): not an outage, so the caller gets the error
+            profiling.timings.observe('store.' + method + ' (error)', time.perf_counter() - started)
+            raise
+        finally:
+            if probe:  # also if the probe was cancelled, or the circuit would stay half-open for good
+                self.breaker.probing = False
+        profiling.timings.observe('store.' + method, time.perf_counter() - started)
+        if self.breaker.record_success() and self.pending_writes:
+            asyncio.ensure_future(self.replay_writes())
+        return result
+
+    @property
+    def health(self):
+        return {'state': 'healthy' if self.breaker.state == CircuitState.CLOSED else 'degraded',
+                'circuit': self.breaker.state.value,
+                'consecutive_failures': self.breaker.failures,
+                'pending_writes': len(self.pending_writes),
+                'rejected_writes': len(self.dead_letters),
+                'snapshot_rules': sum(len(i) for i in self.snapshot.values()),
+                'snapshot_age': round(time.monotonic() - self.snapshot_loaded_at) if self.snapshot_loaded_at else None,
+                'last_error': self.last_error}
+
+    # snapshot maintenance
+
+    def _remember(self, doc):
+        self.snapshot.setdefault(doc['guild'], dict())[tuple(doc['name_indexes'])] = doc
+        self._changed(doc['guild'])
+
+    def _forget(self, name_indexes):
+        for guild_id, rules in self.snapshot.items():
+            if rules.pop(tuple(name_indexes), None) is not None:
+                self._changed(guild_id)
+
+    def _snapshot_rules(self):
+        for rules in self.snapshot.values():
+            yield from rules.values()
+
+    async def refresh_snapshot(self):
+        try:
+            if self.scope is None:
+                docs = await self._call('list_all', timeout=self.snapshot_timeout)
+            else:
+                docs = await self._call('find_by_guilds', list(self.scope()), timeout=self.snapshot_timeout)
+        except StoreUnavailable:
+            return False
+        if self.pending_writes: return False  # the database does not have our queued writes yet
+        snapshot = dict()
+        for doc in docs:
+            snapshot.setdefault(doc['guild'], dict())[tuple(doc['name_indexes'])] = doc
+        self.snapshot = snapshot
+        self.snapshot_loaded_at = time.monotonic()
+        self._changed()
+        return True
+
+    async def load_guild(self, guild_id):
+        try:
+            docs = await self._call('find_by_guild', guild_id, timeout=self.snapshot_timeout)
+        except StoreUnavailable:
+            return False
+        self.snapshot[guild_id] = {tuple(doc['name_indexes']): doc for doc in docs}
+        self._changed(guild_id)
+        return True
+
+    def drop_guild(self, guild_id):
+        if self.snapshot.pop(guild_id, None) is not None:
+            self._changed(guild_id)
+
+    async def replay_writes(self):
+        if self.replay_lock is None:
+            self.replay_lock = asyncio.Lock()
+        async with self.replay_lock:
+            while self.pending_writes:
+                method, args = self.pending_writes[0]
+                try:
+                    try:
+                        await self._call(method, *args)
+                    except tuple(self.inner.duplicate_errors):
+                        if method != 'insert' or not await self._already_inserted(args[0]): raise
+                except StoreUnavailable:
+                    return
+                except Exception as e:
+                    # this write will never succeed, so it must not hold up the writes after it
+                    self.dead_letters.append((method, args, repr(e)))
+                    log.error('queued rule write was rejected', extra={'fields': {'method': method, 'error': repr(e)}})
+                self.pending_writes.pop(0)
+            log.info('replayed queued rule writes')
+
+    async def _already_inserted(self, doc):
+        # A write that timed out may have been applied anyway, so replaying an insert can find its own rule.
+        existing = await self._call('get_by_name', doc['name_indexes'])
+        return existing is not None and storage.rule_identity(existing) == storage.rule_identity(doc)
+
+    async def _write(self, method, *args):
+        if self.pending_writes:  # keep the order of writes
+            self.pending_writes.append((method, args))
+            if self.breaker.state == CircuitState.CLOSED:
+                asyncio.ensure_future(self.replay_writes())
+            return
+        try:
+            await self._call(method, *args)
+        except StoreUnavailable:
+            self.pending_writes.append((method, args))
+
+    # RuleStore interface
+
+    async def setup(self):
+        try:
+            await self._call('setup')
+        except StoreUnavailable:
+            pass
+        await self.refresh_snapshot()
+
+    async def find_by_guild(self, guild_id, channel_id=None):
+        try:
+            return await self._call('find_by_guild', guild_id, channel_id)
+        except StoreUnavailable:
+            return [i for i in self.snapshot.get(guild_id, dict()).values() if channel_id is None or i['channel_to_mention'] == channel_id]
+
+    async def find_by_guilds(self, guild_ids):
+        try:
+            return await self._call('find_by_guilds', guild_ids)
+        except StoreUnavailable:
+            return [i for guild_id in guild_ids for i in self.snapshot.get(guild_id, dict()).values()]
+
+    async def lookup(self, guild_id, user_id, role_ids, action, channel_id):
+        try:
+            return await self._call('lookup', guild_id, user_id, role_ids, action, channel_id)
+        except StoreUnavailable:
+            return [i for i in self.snapshot.get(guild_id, dict()).values() if storage.rule_matches(i, guild_id, user_id, role_ids, action, channel_id)]
+
+    async def find_by_mention(self, guild_id, mention_ids):
+        try:
+            return await self._call('find_by_mention', guild_id, mention_ids)
+        except StoreUnavailable:
+            mention_ids = set(mention_ids)
+            return [i for i in self.snapshot.get(guild_id, dict()).values() if any(j['id'] in mention_ids for j in i.get('users_to_mention') or [])]
+
+    async def get_by_name(self, name_indexes):
+        try:
+            return await self._call('get_by_name', name_indexes)
+        except StoreUnavailable:
+            for doc in self._snapshot_rules():
+                if list(doc['name_indexes']) == list(name_indexes): return doc
+            return None
+
+    async def find_identical(self, doc):
+        try:
+            return await self._call('find_identical', doc)
+        except StoreUnavailable:
+            identity = storage.rule_identity(doc)
+            for i in self.snapshot.get(doc['guild'], dict()).values():
+                if storage.rule_identity(i) == identity and not i.get('disabled'): return i
+            return None
+
+    async def insert(self, doc):
+        self._remember(doc)
+        await self._write('insert', doc)
+
+    async def update_by_name(self, name_indexes, fields):
+        for doc in self._snapshot_rules():
+            if list(doc['name_indexes']) == list(name_indexes):
+                doc.update(fields)
+                self._changed(doc['guild'])
+        await self._write('update_by_name', name_indexes, fields)
+
+    async def delete_by_name(self, name_indexes):
+        self._forget(name_indexes)
+        await self._write('delete_by_name', name_indexes)
+
+    async def delete_many_by_name(self, name_indexes_list):
+        for i in name_indexes_list:
+            self._forget(i)
+        await self._write('delete_many_by_name', name_indexes_list)
+
+    async def disable_many(self, reasons):
+        for indexes, missing in reasons:
+            for doc in self._snapshot_rules():
+                if list(doc['name_indexes']) == list(indexes):
+                    doc['disabled'] = True
+                    doc['disabled_because_missing'] = missing
+                    self._changed(doc['guild'])
+        await self._write('disable_many', reasons)
+
+    async def list_all(self):
+        try:
+            return await self._call('list_all')
+        except StoreUnavailable:
+            return list(self._snapshot_rules())
+
+    async def claim_event(self, key, ttl):
+        try:
+            return await self._call('claim_event', key, ttl)
+        except StoreUnavailable:
+            return True  # a rare duplicate notification is better than a lost one
+
+    async def close(self):
+        await self.inner.close()
@@ -0,0 +1,95 @@
+import cache
+
+import asyncio
+import logging
+
+log = logging.getLogger('notifier.resolver')
+
+QUERY_LIMIT = 100  # the most user IDs Discord accepts in one member chunk request
+UNKNOWN = object()
+
+
+class ModelResolver:
+    # Turns member and role IDs into models with as few API calls as possible.
+    # Members missing from discord.py's cache are requested in batches over the gateway, and lookups that happen
+    # at the same time in the same guild share one batch. Missing roles are found with one role fetch per guild.
+    # Members that are not in the guild anymore are remembered for `negative_ttl` seconds.
+    def __init__(self, members, *, negative_ttl=300, role_ttl=600, max_guild_roles=256):
+        self.members = members  # LRUCache: (guild id, member id) -> Member, or None if they are not in the guild
+        self.negative_ttl = negative_ttl
+        self.roles = cache.LRUCache(max_guild_roles, ttl=role_ttl)  # guild id -> {role id -> Role}
+        self.role_fetches = dict()  # guild id -> task, while fetching
+        self.waiting = dict()  # guild id -> {member id -> [futures]}, for the next batch
+        self.queries = 0
+
+    async def members_by_id(self, guild, member_ids):
+        # Returns {member id -> Member, or None if they are not in the guild}.
+        found = dict()
+        missing = []
+        for member_id in dict.fromkeys(member_ids):
+            member = guild.get_member(member_id)
+            if member is None:
+                member = self.members.get((guild.id, member_id), UNKNOWN)
+            if member is UNKNOWN:
+                missing.append(member_id)
+            else:
+                found[member_id] = member
+        for start in range(0, len(missing), QUERY_LIMIT):
+            chunk = missing[start:start+QUERY_LIMIT]
+            self.queries += 1
+            fetched = {i.id: i for i in await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)}
+            for member_id in chunk:
+                member = fetched.get(member_id)
+                self.members.put((guild.id, member_id), member, ttl=None if member is not None else self.negative_ttl)
+                found[member_id] = member
+        return found
+
+    async def member(self, guild, member_id):
+        member = guild.get_member(member_id)
+        if member is not None: return member
+        member = self.members.get((guild.id, member_id), UNKNOWN)
+        if member is not UNKNOWN: return member
+        future = asyncio.get_running_loop().create_future()
+        waiting = self.waiting.get(guild.id)
+        if waiting is None:
+            waiting = self.waiting[guild.id] = dict()
+            asyncio.ensure_future(self._query_waiting(guild))  # runs after everything that is ready now had a chance to join
+        waiting.setdefault(member_id, []).append(future)
+        return await future
+
+    async def _query_waiting(self, guild):
+        waiting = self.waiting.pop(guild.id)
+        try:
+            found = await self.members_by_id(guild, list(waiting))
+        except Exception as e:
+            # not cached as missing, because we do not know
+            log.warning('member query failed', extra={'fields': {'guild': guild.id, 'members': len(waiting), 'error': repr(e)}})
+            for futures in waiting.values():
+                for future in futures:
+                    if not future.done(): future.set_exception(e)
+            return
+        for member_id, futures in waiting.items():
+            for future in futures:
+                if not future.done(): future.set_result(found.get(member_id))
+
+    async def role(self, guild, role_id):
+        # The role cache is always complete, so a miss almost always means the role was deleted;
+        # fetching is only to be sure, and is done at most once per guild per `role_ttl`.
+        role = guild.get_role(role_id)
+        if role is not None: return role
+        return (await self.fetched_roles(guild)).get(role_id)
+
+    async def fetched_roles(self, guild):
+        roles = self.roles.get(guild.id)
+        if roles is not None: return roles
+        fetch = self.role_fetches.get(guild.id)
+        if fetch is None:
+            fetch = self.role_fetches[guild.id] = asyncio.ensure_future(guild.fetch_roles())
+            fetch.add_done_callback(lambda _: self.role_fetches.pop(guild.id, None))
+            self.queries += 1
+        roles = {i.id: i for i in await fetch}
+        self.roles.put(guild.id, roles)
+        return roles
+
+    def forget_guild(self, guild_id):
+        self.roles.pop(guild_id)
@@ -0,0 +1,143 @@
+import bisect
+import datetime
+import zoneinfo
+
+# A rule's schedule is stored in its document as
+# {'text': str, 'timezone': str, 'windows': [[start, end], ...]}
+# where start and end are minutes since Monday 00:00 in that timezone, start < end,
+# and windows that go past Sunday midnight are split in two.
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def parse_days(token):
+    # "fri", "mon-fri", "sat,sun", "daily"
+    if token in ('daily', 'everyday'):
+        return list(range(7))
+    days = []
+    for part in token.split(','):
+        if '-' in part:
+            first, last = (DAYS.index(i[:3]) for i in part.split('-'))
+            days += [(first + i) % 7 for i in range((last - first) % 7 + 1)]
+        else:
+            days.append(DAYS.index(part[:3]))
+    return days
+
+
+def parse_minute(text):
+    try:
+        hours, minutes = text.split(':')
+        hours, minutes = int(hours), int(minutes)
+    except ValueError:
+        raise ValueError('invalid time: ' + text)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or (hours == 24 and minutes):
+        raise ValueError('invalid time: ' + text)
+    return hours * 60 + minutes
+
+
+def parse_schedule(text):
+    # "fri 18:00-23:00", "mon-fri 09:00-17:00 sat,sun 10:00-02:00 Europe/Berlin".
+    # Each time range applies to the days before it (every day if none were given); a range that ends before it starts
+    # goes past midnight. A timezone name may be given anywhere, the default is UTC.
+    # Raises ValueError if the text cannot be understood.
+    timezone = 'UTC'
+    days = list(range(7))
+    windows = []
+    for token in text.split():
+        lowered = token.lower()
+        if ':' in token:
+            if token.count('-') != 1:
+                raise ValueError('a time range needs a start and an end, like 18:00-23:00: ' + token)
+            start, end = (parse_minute(i) for i in token.split('-'))
+            length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+            for day in days:
+                windows.append((day * MINUTES_PER_DAY + start, day * MINUTES_PER_DAY + start + length))
+        elif '/' in token or lowered == 'utc':
+            if lowered == 'utc':
+                token = 'UTC'
+            try:
+                zoneinfo.ZoneInfo(token)
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                raise ValueError('unknown timezone: ' + token)
+            timezone = token
+        else:
+            try:
+                days = parse_days(lowered)
+            except ValueError:
+                raise ValueError('not a day, time range or timezone: ' + token)
+    if not windows:
+        raise ValueError('no time ranges given')
+
+    # split windows that go past the end of the week, and merge overlapping ones
+    split = []
+    for start, end in windows:
+        if end > MINUTES_PER_WEEK:
+            split += [(start, MINUTES_PER_WEEK), (0, end - MINUTES_PER_WEEK)]
+        else:
+            split.append((start, end))
+    merged = []
+    for start, end in sorted(split):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return {'text': ' '.join(text.split()), 'timezone': timezone, 'windows': merged}
+
+
+def minute_of_week(timezone, now=None):
+    now = datetime.datetime.now(zoneinfo.ZoneInfo(timezone)) if now is None else now.astimezone(zoneinfo.ZoneInfo(timezone))
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+
+def is_active(schedule, now=None):
+    # For a single rule; `ScheduleIndex` answers this for all rules of a guild at once.
+    if not schedule: return True
+    minute = minute_of_week(schedule['timezone'], now)
+    return any(start <= minute < end for start, end in schedule['windows'])
+
+
+class ScheduleIndex:
+    # Which scheduled rules are outside of their windows right now, from the rule store's in-memory snapshot.
+    # Per guild and timezone, the week is cut into segments at every window boundary, and for each segment we keep
+    # the set of scheduled rules that are inactive during it; a lookup is then one binary search per timezone.
+    def __init__(self, store):
+        self.store = store
+        self.compiled = dict()  # guild id -> {timezone -> (segment starts, [set of inactive rule names])}
+        store.listeners.append(self.invalidate)
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.compiled.clear()
+        else:
+            self.compiled.pop(guild_id, None)
+
+    def _compile(self, guild_id):
+        by_timezone = dict()  # timezone -> [(name, windows)]
+        for doc in self.store.snapshot.get(guild_id, dict()).values():
+            if doc.get('schedule') and not doc.get('disabled'):
+                by_timezone.setdefault(doc['schedule']['timezone'], []).append((tuple(doc['name_indexes']), doc['schedule']['windows']))
+        compiled = dict()
+        for timezone, rules in by_timezone.items():
+            starts = sorted({0} | {minute for _, windows in rules for window in windows for minute in window if minute < MINUTES_PER_WEEK})
+            inactive = [set() for _ in starts]
+            for name, windows in rules:
+                for index, segment_start in enumerate(starts):
+                    if not any(start <= segment_start < end for start, end in windows):
+                        inactive[index].add(name)
+            compiled[timezone] = (starts, inactive)
+        self.compiled[guild_id] = compiled
+        return compiled
+
+    def inactive(self, guild_id, now=None):
+        # Returns the names (tuples of indexes) of the rules that are scheduled to be inactive now,
+        # or None if the snapshot was not loaded yet.
+        if self.store.snapshot_loaded_at is None: return None
+        compiled = self.compiled.get(guild_id)
+        if compiled is None:
+            compiled = self._compile(guild_id)
+        names = set()
+        for timezone, (starts, inactive) in compiled.items():
+            names |= inactive[bisect.bisect_right(starts, minute_of_week(timezone, now)) - 1]
+        return names
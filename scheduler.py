@@ -0,0 +1,126 @@
+import asyncio
+import collections
+import logging
+import time
+
+log = logging.getLogger('notifier.scheduler')
+
+
+class GuildScheduler:
+    # Runs jobs from a queue per guild with weighted deficit round-robin, so a burst in one big guild
+    # only delays that guild's own jobs and everybody else keeps getting their turn.
+    # Each guild also has a limit on jobs running at once and on jobs waiting.
+    # A job's cost must not be larger than quantum * weight, so that every guild can run something each round.
+    # Jobs submitted with the same `key` (like one member's voice events) never run at the same time, and run in order.
+    def __init__(self, *, workers=8, quantum=1, max_in_flight_per_guild=2, max_queued_per_guild=1000, weights=None):
+        self.worker_count = workers
+        self.quantum = quantum
+        self.max_in_flight_per_guild = max_in_flight_per_guild
+        self.max_queued_per_guild = max_queued_per_guild
+        self.weights = dict(weights or {})  # guild id -> weight, default 1
+        self.queues = dict()  # guild id -> deque of (cost, job, time enqueued, key)
+        self.active = collections.deque()  # guild ids that have queued jobs, in round-robin order
+        self.deficit = dict()  # guild id -> cost this guild may still spend in its current turn
+        self.in_flight = collections.Counter()
+        self.running_keys = set()
+        self.dropped = collections.Counter()
+        self.max_wait = dict()  # guild id -> longest time a job waited in the queue since the last stats call
+        self.wakeup = None  # created in start(), so that it belongs to the running event loop
+        self.workers = []
+
+    def start(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        for _ in range(self.worker_count - len(self.workers)):
+            self.workers.append(asyncio.ensure_future(self._work()))
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    def weight(self, guild_id):
+        return self.weights.get(guild_id, 1)
+
+    def submit(self, guild_id, job, cost=1, key=None):
+        # `job` is a function that returns an awaitable; it is only called once the job is scheduled.
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = collections.deque()
+            self.deficit[guild_id] = self.quantum * self.weight(guild_id)
+            self.active.append(guild_id)
+        if len(queue) >= self.max_queued_per_guild:
+            self.dropped[guild_id] += 1
+            return False
+        queue.append((cost, job, time.monotonic(), key))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return True
+
+    def _pick(self):
+        # Each guild at the head of the round may run jobs while it has enough deficit left;
+        # then it goes to the back with a fresh quantum. Guilds at their in-flight limit are skipped,
+        # and so are guilds whose next job has to wait for an earlier job with the same key.
+        skipped = 0
+        while self.active and skipped < len(self.active):
+            guild_id = self.active[0]
+            queue = self.queues[guild_id]
+            key = queue[0][3]
+            if self.in_flight[guild_id] >= self.max_in_flight_per_guild or (key is not None and key in self.running_keys):
+                self.active.rotate(-1)
+                skipped += 1
+                continue
+            cost = queue[0][0]
+            if self.deficit[guild_id] < cost:
+                self.deficit[guild_id] += self.quantum * self.weight(guild_id)
+                self.active.rotate(-1)
+                continue
+            self.deficit[guild_id] -= cost
+            item = queue.popleft()
+            if not queue:
+                self.active.popleft()
+                del self.queues[guild_id]
+                del self.deficit[guild_id]
+            return guild_id, item
+        return None
+
+    async def _work(self):
+        while True:
+            picked = self._pick()
+            if picked is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            guild_id, (cost, job, enqueued_at, key) = picked
+            waited = time.monotonic() - enqueued_at
+            if waited > self.max_wait.get(guild_id, 0):
+                self.max_wait[guild_id] = waited
+            self.in_flight[guild_id] += 1
+            if key is not None:
+                self.running_keys.add(key)
+            try:
+                await job()
+            except Exception:
+                log.exception('scheduled job failed', extra={'fields': {'guild': guild_id}})
+            finally:
+                self.running_keys.discard(key)
+                self.in_flight[guild_id] -= 1
+                if not self.in_flight[guild_id]:
+                    del self.in_flight[guild_id]
+                self.wakeup.set()  # a guild that was at its in-flight limit may be able to run again
+
+    def backlog(self, guild_id):
+        return len(self.queues.get(guild_id, ()))
+
+    def stats(self, top=10):
+        # The guilds with the largest backlog, and how long their jobs had to wait since the last call.
+        guild_ids = set(self.queues) | set(self.in_flight) | set(self.max_wait)
+        busiest = sorted(guild_ids, key=lambda i: (self.backlog(i), self.in_flight[i]), reverse=True)[:top]
+        result = {'queued': sum(len(q) for q in self.queues.values()),
+                  'in_flight': sum(self.in_flight.values()),
+                  'guilds_waiting': len(self.active),
+                  'dropped': sum(self.dropped.values()),
+                  'guilds': [{'guild': i, 'queued': self.backlog(i), 'in_flight': self.in_flight[i],
+                              'max_wait': round(self.max_wait.get(i, 0), 3), 'dropped': self.dropped[i]} for i in busiest]}
+        self.max_wait.clear()
+        return result
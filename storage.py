@@ -0,0 +1,388 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger('notifier.store')
+
+# Rules are stored as plain documents, in the format produced by `Rule.to_json()`:
+# {'guild': int, 'trigger': {'userlike': {'type': str, 'id': int} or None, 'action': str, 'channel': int or None},
+#  'channel_to_mention': int, 'users_to_mention': [{'type': str, 'id': int}], 'name_indexes': [int, int, int],
+#  'disabled': bool (optional), 'delivery': 'instant' or 'digest' (optional, default 'instant'),
+#  'schedule': see schedule.py (optional, None for always active)}
+
+IDENTITY_FIELDS = ['guild', 'trigger', 'channel_to_mention', 'users_to_mention']
+
+
+def rule_identity(doc):
+    # Two rules are identical if they only differ in name.
+    return json.dumps({k: doc.get(k) for k in IDENTITY_FIELDS}, sort_keys=True)
+
+
+def rule_matches(doc, guild_id, user_id, role_ids, action, channel_id):
+    # Same semantics as the query in `MotorRuleStore.lookup`, for matching rules that are already in memory.
+    if doc['guild'] != guild_id or doc.get('disabled'): return False
+    trigger = doc['trigger']
+    if trigger['action'] != action: return False
+    if trigger.get('channel') is not None and trigger['channel'] != channel_id: return False
+    userlike = trigger.get('userlike')
+    if userlike is None: return True
+    if userlike['type'] == 'member': return userlike['id'] == user_id
+    return userlike['id'] in role_ids
+
+
+class RuleStore:
+    # Interface for rule storage backends. All methods take and return plain rule documents.
+    # Errors of these types mean the database could not be reached, as opposed to a bad request or a bug.
+    connection_errors = ()
+    # Errors of these types mean that a rule with the same name already exists.
+    duplicate_errors = ()
+
+    async def setup(self):
+        pass
+
+    async def find_by_guild(self, guild_id, channel_id=None):
+        raise NotImplementedError
+
+    async def find_by_guilds(self, guild_ids):
+        # For loading only the rules of the guilds this process is responsible for.
+        raise NotImplementedError
+
+    async def lookup(self, guild_id, user_id, role_ids, action, channel_id):
+        # Returns the enabled rules that match a voice event.
+        raise NotImplementedError
+
+    async def find_by_mention(self, guild_id, mention_ids):
+        # Returns the rules that mention any of these members or roles. Discord IDs are unique across types,
+        # so a member's ID and the IDs of their roles can be looked up together.
+        raise NotImplementedError
+
+    async def get_by_name(self, name_indexes):
+        raise NotImplementedError
+
+    async def find_identical(self, doc):
+        # Disabled rules are not counted, so that a rule disabled by the sweep can be created again.
+        raise NotImplementedError
+
+    async def insert(self, doc):
+        raise NotImplementedError
+
+    async def update_by_name(self, name_indexes, fields):
+        # Sets top-level fields that are not part of the rule's identity, like 'delivery'.
+        raise NotImplementedError
+
+    async def delete_by_name(self, name_indexes):
+        raise NotImplementedError
+
+    async def delete_many_by_name(self, name_indexes_list):
+        raise NotImplementedError
+
+    async def disable_many(self, reasons):
+        # `reasons` is a list of (name_indexes, [missing references]) pairs.
+        raise NotImplementedError
+
+    async def list_all(self):
+        raise NotImplementedError
+
+    async def claim_event(self, key, ttl):
+        # Records that this process handles the event with this fingerprint. Returns False if another process
+        # already claimed it in the last `ttl` seconds, so that every event is only notified once.
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MotorRuleStore(RuleStore):
+    def __init__(self, uri, **client_options):
+        import motor.motor_asyncio
+        import pymongo.errors
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(uri, **client_options)
+        self.connection_errors = (pymongo.errors.ConnectionFailure,)  # includes timeouts and failed server selection
+        self.duplicate_errors = (pymongo.errors.DuplicateKeyError,)
+        self.rules = self.client.db.rules
+        self.event_claims = self.client.db.event_claims
+
+    async def setup(self):
+        import pymongo.errors
+        await self.rules.create_index([('guild', 1), ('trigger.action', 1)])
+        await self.rules.create_index([('guild', 1), ('channel_to_mention', 1)])
+        # Names must be unique, so that an insert that is replayed after it timed out cannot add the rule twice.
+        # Older versions created this index without `unique`, and it cannot be changed in place.
+        indexes = await self.rules.index_information()
+        if 'name_indexes_1' in indexes and not indexes['name_indexes_1'].get('unique'):
+            await self.rules.drop_index('name_indexes_1')
+        try:
+            await self.rules.create_index('name_indexes', unique=True)
+        except pymongo.errors.DuplicateKeyError:
+            # keep working with the rules as they are, until the duplicates are deleted
+            log.warning('rules share a name, name_indexes is not unique', exc_info=True)
+            await self.rules.create_index('name_indexes')
+        await self.rules.create_index([('guild', 1), ('users_to_mention.id', 1)])
+        await self.event_claims.create_index('expires_at', expireAfterSeconds=0)  # MongoDB removes expired claims
+
+    async def find_by_guild(self, guild_id, channel_id=None):
+        query = {'guild': guild_id}
+        if channel_id is not None:
+            query['channel_to_mention'] = channel_id
+        return await self.rules.find(query).to_list(None)
+
+    async def find_by_guilds(self, guild_ids):
+        return await self.rules.find({'guild': {'$in': list(guild_ids)}}).to_list(None)
+
+    async def lookup(self, guild_id, user_id, role_ids, action, channel_id):
+        # match user
+        this_user = {'trigger.userlike.type': 'member',
+                     'trigger.userlike.id': user_id}
+
+        # match roles of user
+        these_roles = {'trigger.userlike.type': 'role',
+                       'trigger.userlike.id': {'$in': list(role_ids)}}
+
+        # rule does not limit user
+        no_user_limitation = {'trigger.userlike': None}
+
+        correct_user = {'$or': [this_user, these_roles, no_user_limitation]}
+
+        correct_action = {'trigger.action': action}
+
+        correct_channel = {'$or': [{'trigger.channel': channel_id}, {'trigger.channel': None}]}
+
+        not_disabled = {'disabled': {'$ne': True}}
+
+        compound_query = {'$and': [{'guild': guild_id}, correct_user, correct_action, correct_channel, not_disabled]}
+        return await self.rules.find(compound_query).to_list(None)
+
+    async def find_by_mention(self, guild_id, mention_ids):
+        return await self.rules.find({'guild': guild_id, 'users_to_mention.id': {'$in': list(mention_ids)}}).to_list(None)
+
+    async def get_by_name(self, name_indexes):
+        return await self.rules.find_one({'name_indexes': name_indexes})
+
+    async def find_identical(self, doc):
+        return await self.rules.find_one({**{k: doc[k] for k in IDENTITY_FIELDS}, 'disabled': {'$ne': True}})
+
+    async def insert(self, doc):
+        await self.rules.insert_one(dict(doc))
+
+    async def update_by_name(self, name_indexes, fields):
+        await self.rules.update_one({'name_indexes': name_indexes}, {'$set': dict(fields)})
+
+    async def delete_by_name(self, name_indexes):
+        await self.rules.delete_one({'name_indexes': name_indexes})
+
+    async def delete_many_by_name(self, name_indexes_list):
+        await self.rules.delete_many({'name_indexes': {'$in': list(name_indexes_list)}})
+
+    async def disable_many(self, reasons):
+        import pymongo
+        await self.rules.bulk_write([pymongo.UpdateOne({'name_indexes': indexes}, {'$set': {'disabled': True, 'disabled_because_missing': missing}})
+                                     for indexes, missing in reasons], ordered=False)
+
+    async def list_all(self):
+        return await self.rules.find({}).to_list(None)
+
+    async def claim_event(self, key, ttl):
+        import pymongo
+        try:
+            await self.event_claims.insert_one({'_id': key, 'expires_at': datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)})
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    async def close(self):
+        self.client.close()
+
+
+class SQLiteRuleStore(RuleStore):
+    # Embedded backend for small deployments and tests. `path` may be ':memory:'.
+    # All queries run on a single worker thread, which owns the connection.
+    connection_errors = (sqlite3.OperationalError,)  # the database is locked, or the file cannot be read or written
+    duplicate_errors = (sqlite3.IntegrityError,)  # the name is the primary key
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS rules (
+        name TEXT PRIMARY KEY,
+        guild INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        trigger_type TEXT,
+        trigger_id INTEGER,
+        trigger_channel INTEGER,
+        channel_to_mention INTEGER,
+        identity TEXT NOT NULL,
+        disabled INTEGER NOT NULL DEFAULT 0,
+        doc TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS rules_lookup ON rules (guild, action, disabled);
+    CREATE INDEX IF NOT EXISTS rules_by_channel ON rules (guild, channel_to_mention);
+    CREATE INDEX IF NOT EXISTS rules_identity ON rules (identity);
+    CREATE TABLE IF NOT EXISTS rule_mentions (
+        name TEXT NOT NULL REFERENCES rules (name) ON DELETE CASCADE,
+        guild INTEGER NOT NULL,
+        mention_id INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS rule_mentions_lookup ON rule_mentions (guild, mention_id);
+    CREATE INDEX IF NOT EXISTS rule_mentions_name ON rule_mentions (name);
+    CREATE TABLE IF NOT EXISTS event_claims (
+        key TEXT PRIMARY KEY,
+        expires_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS event_claims_expiry ON event_claims (expires_at);
+    '''
+
+    def __init__(self, path=':memory:'):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-rules')
+        self.conn = self.executor.submit(self._connect, path).result()
+
+    @classmethod
+    def _connect(cls, path):
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        if path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.executescript(cls.SCHEMA)
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _query(self, sql, params=()):
+        return [json.loads(row[0]) for row in self.conn.execute(sql, params)]
+
+    @contextlib.contextmanager
+    def _transaction(self, begin='BEGIN'):
+        # The connection is in autocommit mode, so that reads never hold a transaction open;
+        # writes that change several rows are grouped explicitly, and rolled back if any of them fails.
+        self.conn.execute(begin)
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    @staticmethod
+    def _name(name_indexes):
+        return json.dumps(list(name_indexes))
+
+    async def find_by_guild(self, guild_id, channel_id=None):
+        if channel_id is None:
+            return await self._run(self._query, 'SELECT doc FROM rules WHERE guild = ?', (guild_id,))
+        return await self._run(self._query, 'SELECT doc FROM rules WHERE guild = ? AND channel_to_mention = ?', (guild_id, channel_id))
+
+    def _find_by_guilds(self, guild_ids):
+        found = []
+        for start in range(0, len(guild_ids), 500):  # stay well below SQLite's limit on query parameters
+            chunk = guild_ids[start:start+500]
+            found += self._query('SELECT doc FROM rules WHERE guild IN (' + ', '.join('?' * len(chunk)) + ')', chunk)
+        return found
+
+    async def find_by_guilds(self, guild_ids):
+        return await self._run(self._find_by_guilds, list(guild_ids))
+
+    async def lookup(self, guild_id, user_id, role_ids, action, channel_id):
+        role_ids = list(role_ids)
+        sql = ('SELECT doc FROM rules WHERE guild = ? AND action = ? AND disabled = 0'
+               ' AND (trigger_channel IS NULL OR trigger_channel = ?)'
+               " AND (trigger_type IS NULL OR (trigger_type = 'member' AND trigger_id = ?)"
+               " OR (trigger_type = 'role' AND trigger_id IN (" + ', '.join('?' * len(role_ids)) + ')))')
+        return await self._run(self._query, sql, [guild_id, action, channel_id, user_id] + role_ids)
+
+    def _find_by_mention(self, guild_id, mention_ids):
+        return self._query('SELECT doc FROM rules WHERE name IN (SELECT name FROM rule_mentions WHERE guild = ? AND mention_id IN ('
+                           + ', '.join('?' * len(mention_ids)) + '))', [guild_id] + mention_ids)
+
+    async def find_by_mention(self, guild_id, mention_ids):
+        return await self._run(self._find_by_mention, guild_id, list(mention_ids))
+
+    async def get_by_name(self, name_indexes):
+        found = await self._run(self._query, 'SELECT doc FROM rules WHERE name = ?', (self._name(name_indexes),))
+        return found[0] if found else None
+
+    async def find_identical(self, doc):
+        found = await self._run(self._query, 'SELECT doc FROM rules WHERE identity = ? AND disabled = 0 LIMIT 1', (rule_identity(doc),))
+        return found[0] if found else None
+
+    def _insert(self, doc):
+        userlike = doc['trigger'].get('userlike')
+        with self._transaction():
+            self.conn.execute('INSERT INTO rules (name, guild, action, trigger_type, trigger_id, trigger_channel, channel_to_mention, identity, disabled, doc)'
+                              ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (self._name(doc['name_indexes']), doc['guild'], doc['trigger']['action'],
+                               userlike['type'] if userlike else None, userlike['id'] if userlike else None,
+                               doc['trigger'].get('channel'), doc['channel_to_mention'], rule_identity(doc),
+                               int(bool(doc.get('disabled'))), json.dumps(doc)))
+            self.conn.executemany('INSERT INTO rule_mentions (name, guild, mention_id) VALUES (?, ?, ?)',
+                                  [(self._name(doc['name_indexes']), doc['guild'], i['id']) for i in doc.get('users_to_mention') or []])
+
+    async def insert(self, doc):
+        await self._run(self._insert, doc)
+
+    def _update(self, name, fields):
+        with self._transaction():
+            for (doc,) in self.conn.execute('SELECT doc FROM rules WHERE name = ?', (name,)).fetchall():
+                doc = json.loads(doc)
+                doc.update(fields)
+                self.conn.execute('UPDATE rules SET disabled = ?, doc = ? WHERE name = ?', (int(bool(doc.get('disabled'))), json.dumps(doc), name))
+
+    async def update_by_name(self, name_indexes, fields):
+        await self._run(self._update, self._name(name_indexes), dict(fields))
+
+    async def delete_by_name(self, name_indexes):
+        await self._run(self.conn.execute, 'DELETE FROM rules WHERE name = ?', (self._name(name_indexes),))
+
+    def _delete_many(self, names):
+        with self._transaction():
+            self.conn.executemany('DELETE FROM rules WHERE name = ?', [(i,) for i in names])
+
+    async def delete_many_by_name(self, name_indexes_list):
+        await self._run(self._delete_many, [self._name(i) for i in name_indexes_list])
+
+    def _disable_many(self, reasons):
+        with self._transaction():
+            for indexes, missing in reasons:
+                name = self._name(indexes)
+                for (doc,) in self.conn.execute('SELECT doc FROM rules WHERE name = ?', (name,)).fetchall():
+                    doc = json.loads(doc)
+                    doc['disabled'] = True
+                    doc['disabled_because_missing'] = missing
+                    self.conn.execute('UPDATE rules SET disabled = 1, doc = ? WHERE name = ?', (json.dumps(doc), name))
+
+    async def disable_many(self, reasons):
+        await self._run(self._disable_many, list(reasons))
+
+    async def list_all(self):
+        return await self._run(self._query, 'SELECT doc FROM rules')
+
+    def _claim(self, key, ttl):
+        now = time.time()
+        with self._transaction('BEGIN IMMEDIATE'):  # the check and the claim must not interleave with another process
+            self.conn.execute('DELETE FROM event_claims WHERE expires_at <= ?', (now,))
+            return self.conn.execute('INSERT OR IGNORE INTO event_claims (key, expires_at) VALUES (?, ?)', (key, now + ttl)).rowcount == 1
+
+    async def claim_event(self, key, ttl):
+        return await self._run(self._claim, key, ttl)
+
+    async def close(self):
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=False)
+
+
+def store_from_env():
+    backend = os.getenv('RULE_STORE') or 'mongo'
+    if backend == 'mongo':
+        options = {}
+        for option, variable in [('maxPoolSize', 'MONGO_MAX_POOL_SIZE'), ('minPoolSize', 'MONGO_MIN_POOL_SIZE')]:
+            if os.getenv(variable):
+                options[option] = int(os.getenv(variable))
+        return MotorRuleStore(os.getenv('MONGO_URI') or 'mongodb://mongo:27017/', **options)
+    if backend == 'sqlite':
+        return SQLiteRuleStore(os.getenv('SQLITE_PATH') or 'rules.sqlite3')
+    if backend == 'memory':
+        return SQLiteRuleStore(':memory:')
+    raise ValueError('Unknown RULE_STORE: ' + backend)
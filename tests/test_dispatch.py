@@ -0,0 +1,56 @@
+import dispatch
+
+import enum
+import types
+
+
+class Kind(enum.Enum):
+    MEMBER = 'member'
+    ROLE = 'role'
+
+
+class Mention:
+    def __init__(self, kind, id):
+        self.type = kind
+        self.id = id
+
+    def as_mention(self):
+        return ('<@' if self.type == Kind.MEMBER else '<@&') + str(self.id) + '>'
+
+
+def rule(channel_id, mentions, name='rule'):
+    return types.SimpleNamespace(name=name, channel_to_mention_id=channel_id, channel_to_mention='channel ' + str(channel_id),
+                                 users_to_mention=mentions)
+
+
+def test_one_message_per_channel_with_merged_mentions():
+    alice, bob, admins = Mention(Kind.MEMBER, 1), Mention(Kind.MEMBER, 2), Mention(Kind.ROLE, 3)
+    first, second, other = rule(10, [alice, admins]), rule(10, [Mention(Kind.MEMBER, 1), bob]), rule(20, [])
+    messages = dispatch.plan([first, second, other], 'somebody joined')
+    assert [i.channel_id for i in messages] == [10, 20]
+    assert messages[0].content == '<@1> <@&3> <@2> somebody joined'
+    assert messages[0].rules == [first, second]
+    assert messages[1].content == 'somebody joined'
+    assert [i.id for i in messages[0].allowed_mentions.users] == [1, 2]
+    assert [i.id for i in messages[0].allowed_mentions.roles] == [3]
+    assert messages[0].allowed_mentions.everyone is False
+
+
+def test_long_mention_lists_are_split():
+    mentions = [Mention(Kind.MEMBER, 10**17 + i) for i in range(200)]  # 21 characters each, with the space
+    messages = dispatch.plan([rule(10, mentions)], 'somebody joined')
+    assert len(messages) == 3
+    assert all(len(i.content) <= dispatch.MESSAGE_LIMIT for i in messages)
+    assert messages[0].content.endswith(' somebody joined')
+    assert messages[0].rules is not None and messages[1].rules is None and messages[2].rules is None
+    mentioned = ' '.join(i.content for i in messages).replace(' somebody joined', '').split()
+    assert mentioned == [i.as_mention() for i in mentions]
+    for message in messages:
+        assert len(message.allowed_mentions.users) == message.content.count('<@')
+
+
+def test_rule_list_is_cut_off():
+    rules = [types.SimpleNamespace(name='rule-number-' + str(i)) for i in range(500)]
+    text = dispatch.rule_list_text(rules)
+    assert len(text) <= dispatch.RULE_LIST_LIMIT
+    assert text.endswith(' more')
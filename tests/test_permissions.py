@@ -0,0 +1,26 @@
+import permissions
+
+import types
+
+
+class Channel:
+    def __init__(self, perms):
+        self.id = 3
+        self.guild = types.SimpleNamespace(id=1, me=object())
+        self.perms = perms
+        self.checks = 0
+
+    def permissions_for(self, member):
+        self.checks += 1
+        return self.perms
+
+
+def test_denied_permissions_are_checked_again():
+    channel = Channel(types.SimpleNamespace(view_channel=True, send_messages=False, embed_links=True))
+    cache = permissions.PermissionCache(denied_ttl=0)
+    assert not cache.permissions(channel).send_messages
+    channel.perms = types.SimpleNamespace(view_channel=True, send_messages=True, embed_links=True)
+    assert cache.permissions(channel).send_messages
+    # permissions that allow sending are kept until they are invalidated
+    cache.permissions(channel)
+    assert channel.checks == 2
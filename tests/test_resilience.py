@@ -0,0 +1,110 @@
+import resilience
+import storage
+
+import asyncio
+import sqlite3
+
+
+def rule(number, guild=1):
+    return {'guild': guild, 'trigger': {'userlike': None, 'action': 'joins', 'channel': None},
+            'channel_to_mention': 5, 'users_to_mention': [], 'name_indexes': [number, 0, 0]}
+
+
+class FlakyStore(storage.SQLiteRuleStore):
+    # An in-memory store whose database can be taken down.
+    def __init__(self):
+        super().__init__()
+        self.down = False
+
+    async def _run(self, func, *args):
+        if self.down:
+            raise sqlite3.OperationalError('database is down')
+        return await super()._run(func, *args)
+
+
+def names(docs):
+    return sorted(doc['name_indexes'][0] for doc in docs)
+
+
+def test_writes_are_queued_and_replayed_in_order():
+    async def run():
+        inner = FlakyStore()
+        store = resilience.ResilientRuleStore(inner, failure_threshold=1, reset_timeout=0)
+        await store.setup()
+        await store.insert(rule(1))
+        inner.down = True
+        await store.insert(rule(2))
+        await store.delete_by_name([1, 0, 0])
+        assert len(store.pending_writes) == 2
+        assert names(await store.find_by_guild(1)) == [2]  # served from the snapshot
+        inner.down = False
+        await store.replay_writes()
+        assert store.pending_writes == []
+        assert names(await inner.list_all()) == [2]
+    asyncio.run(run())
+
+
+def test_rejected_write_does_not_block_replay():
+    async def run():
+        inner = FlakyStore()
+        store = resilience.ResilientRuleStore(inner)
+        await store.setup()
+        await inner.insert(rule(1))
+        other = dict(rule(1), channel_to_mention=6)  # a different rule with a name that is taken
+        store.pending_writes = [('insert', (other,)), ('insert', (rule(2),))]
+        await store.replay_writes()
+        assert store.pending_writes == []
+        assert [method for method, _, _ in store.dead_letters] == ['insert']
+        assert names(await inner.list_all()) == [1, 2]
+        assert await store.refresh_snapshot()
+    asyncio.run(run())
+
+
+def test_replayed_insert_that_already_landed_is_not_rejected():
+    async def run():
+        inner = FlakyStore()
+        store = resilience.ResilientRuleStore(inner)
+        await store.setup()
+        await inner.insert(rule(1))  # the write timed out, but was applied
+        store.pending_writes = [('insert', (rule(1),))]
+        await store.replay_writes()
+        assert store.pending_writes == []
+        assert list(store.dead_letters) == []
+        assert names(await inner.list_all()) == [1]
+    asyncio.run(run())
+
+
+def test_errors_that_are_not_outages_reach_the_caller():
+    async def run():
+        store = resilience.ResilientRuleStore(FlakyStore(), failure_threshold=1)
+        await store.setup()
+        await store.insert(rule(1))
+        try:
+            await store.insert(rule(1))
+        except sqlite3.IntegrityError:
+            pass
+        else:
+            raise AssertionError('expected IntegrityError')
+        assert store.breaker.state == resilience.CircuitState.CLOSED
+    asyncio.run(run())
+
+
+def test_cancelled_probe_releases_the_breaker():
+    class SlowStore(FlakyStore):
+        async def list_all(self):
+            await asyncio.sleep(10)
+
+    async def run():
+        store = resilience.ResilientRuleStore(SlowStore(), reset_timeout=0)
+        store.breaker.state = resilience.CircuitState.OPEN
+        store.breaker.opened_at = 0
+        probe = asyncio.ensure_future(store.list_all())
+        await asyncio.sleep(0.01)
+        assert store.breaker.probing
+        probe.cancel()
+        try:
+            await probe
+        except asyncio.CancelledError:
+            pass
+        assert store.breaker.allow()
+    asyncio.run(run())
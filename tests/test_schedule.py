@@ -0,0 +1,66 @@
+import schedule
+
+import datetime
+import types
+
+import pytest
+
+
+def at(weekday, hour, minute=0):
+    # 2026-10-12 is a Monday
+    return datetime.datetime(2026, 10, 12 + weekday, hour, minute, tzinfo=datetime.timezone.utc)
+
+
+def test_parse_days_and_ranges():
+    parsed = schedule.parse_schedule('mon-wed 09:00-17:00 fri 18:00-23:00')
+    assert parsed['timezone'] == 'UTC'
+    assert parsed['windows'] == [[540, 1020], [1980, 2460], [3420, 3900], [6840, 7140]]
+
+
+def test_ranges_past_midnight_and_past_the_end_of_the_week():
+    assert schedule.parse_schedule('sun 23:00-01:00')['windows'] == [[0, 60], [10020, 10080]]
+    assert schedule.parse_schedule('sat 22:00-02:00')['windows'] == [[8520, 8760]]
+
+
+def test_overlapping_windows_are_merged():
+    assert schedule.parse_schedule('mon 10:00-12:00 11:00-13:00')['windows'] == [[600, 780]]
+
+
+def test_timezones():
+    assert schedule.parse_schedule('fri 18:00-23:00 Europe/Berlin')['timezone'] == 'Europe/Berlin'
+    assert schedule.parse_schedule('fri 18:00-23:00 utc')['timezone'] == 'UTC'
+
+
+@pytest.mark.parametrize('text', ['fri', 'fri 18:00', 'fri 18:00-23:00-01:00', 'fri 18:xx-23:00', 'fri 25:00-26:00',
+                                  'someday 10:00-11:00', 'mon 10:00-11:00 Mars/Base'])
+def test_invalid_schedules(text):
+    with pytest.raises(ValueError) as error:
+        schedule.parse_schedule(text)
+    assert 'unpack' not in str(error.value)
+
+
+def test_is_active_uses_the_schedule_timezone():
+    berlin = schedule.parse_schedule('fri 18:00-23:00 Europe/Berlin')
+    assert schedule.is_active(berlin, at(4, 17))  # 19:00 in Berlin
+    assert not schedule.is_active(berlin, at(4, 22))  # midnight in Berlin
+    assert schedule.is_active(None, at(0, 0))
+
+
+def test_schedule_index_matches_is_active():
+    schedules = {1: schedule.parse_schedule('fri 18:00-23:00'),
+                 2: schedule.parse_schedule('daily 00:00-12:00'),
+                 3: schedule.parse_schedule('sat,sun 22:00-02:00 Europe/Berlin'),
+                 4: None}
+    snapshot = {1: {(number, 0, 0): {'name_indexes': [number, 0, 0], 'schedule': sched} for number, sched in schedules.items()}}
+    store = types.SimpleNamespace(snapshot=snapshot, snapshot_loaded_at=1, listeners=[])
+    index = schedule.ScheduleIndex(store)
+    for day in range(7):
+        for hour in range(24):
+            now = at(day, hour, 30)
+            expected = {(number, 0, 0) for number, sched in schedules.items() if not schedule.is_active(sched, now)}
+            assert index.inactive(1, now) == expected
+
+
+def test_schedule_index_waits_for_the_snapshot():
+    store = types.SimpleNamespace(snapshot={}, snapshot_loaded_at=None, listeners=[])
+    assert schedule.ScheduleIndex(store).inactive(1) is None
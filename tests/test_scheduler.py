@@ -0,0 +1,77 @@
+import scheduler
+
+import asyncio
+
+
+def noop():
+    async def job():
+        pass
+    return job
+
+
+def pick_order(sched, count):
+    picked = []
+    for _ in range(count):
+        guild_id, _ = sched._pick()
+        picked.append(guild_id)
+    return picked
+
+
+def test_guilds_take_turns():
+    sched = scheduler.GuildScheduler(max_in_flight_per_guild=100)
+    for _ in range(5):
+        sched.submit(1, noop())
+    sched.submit(2, noop())
+    sched.submit(3, noop())
+    # the busy guild does not make the others wait for its whole backlog
+    assert pick_order(sched, 7) == [1, 2, 3, 1, 1, 1, 1]
+    assert sched._pick() is None
+
+
+def test_weights_give_bigger_turns():
+    sched = scheduler.GuildScheduler(max_in_flight_per_guild=100, weights={1: 3})
+    for _ in range(4):
+        sched.submit(1, noop())
+        sched.submit(2, noop())
+    assert pick_order(sched, 8) == [1, 1, 1, 2, 1, 2, 2, 2]
+
+
+def test_guild_at_in_flight_limit_is_skipped():
+    sched = scheduler.GuildScheduler(max_in_flight_per_guild=1)
+    sched.submit(1, noop())
+    sched.submit(1, noop())
+    sched.submit(2, noop())
+    sched.in_flight[1] = 1
+    assert pick_order(sched, 1) == [2]
+    assert sched._pick() is None
+
+
+def test_full_queue_drops_jobs():
+    sched = scheduler.GuildScheduler(max_queued_per_guild=2)
+    assert sched.submit(1, noop())
+    assert sched.submit(1, noop())
+    assert not sched.submit(1, noop())
+    assert sched.submit(2, noop())
+    assert sched.stats()['dropped'] == 1
+    assert sched.backlog(1) == 2
+
+
+def test_jobs_with_the_same_key_run_one_at_a_time_in_order():
+    async def run():
+        sched = scheduler.GuildScheduler(workers=4, max_in_flight_per_guild=4)
+        log = []
+
+        def job(name, delay):
+            async def run_job():
+                log.append(name + ' start')
+                await asyncio.sleep(delay)
+                log.append(name + ' end')
+            return run_job
+
+        sched.start()
+        sched.submit(1, job('join', 0.02), key=(1, 10))
+        sched.submit(1, job('leave', 0), key=(1, 10))
+        await asyncio.sleep(0.05)
+        sched.stop()
+        return log
+    assert asyncio.run(run()) == ['join start', 'join end', 'leave start', 'leave end']
@@ -0,0 +1,51 @@
+import storage
+
+import asyncio
+
+
+def rule(number, guild=1, mentions=()):
+    return {'guild': guild, 'trigger': {'userlike': None, 'action': 'joins', 'channel': None},
+            'channel_to_mention': 5, 'users_to_mention': [{'type': 'member', 'id': i} for i in mentions],
+            'name_indexes': [number, 0, 0]}
+
+
+def test_disabled_rules_are_not_identical():
+    async def run():
+        store = storage.SQLiteRuleStore()
+        await store.insert(rule(1, mentions=[7]))
+        identity = rule(2, mentions=[7])
+        del identity['name_indexes']
+        assert (await store.find_identical(identity))['name_indexes'] == [1, 0, 0]
+        await store.disable_many([([1, 0, 0], ['member 7'])])
+        assert await store.find_identical(identity) is None
+        await store.close()
+    asyncio.run(run())
+
+
+def test_failed_insert_leaves_no_rule_behind():
+    async def run():
+        store = storage.SQLiteRuleStore()
+        doc = rule(1)
+        doc['users_to_mention'] = [{'type': 'member'}]  # no id
+        try:
+            await store.insert(doc)
+        except KeyError:
+            pass
+        assert await store.list_all() == []
+        assert not store.conn.in_transaction
+        await store.close()
+    asyncio.run(run())
+
+
+def test_batched_writes_apply_together():
+    async def run():
+        store = storage.SQLiteRuleStore()
+        for number in range(3):
+            await store.insert(rule(number, mentions=[7]))
+        await store.disable_many([([0, 0, 0], ['member 7']), ([1, 0, 0], ['member 7'])])
+        assert sorted(doc['name_indexes'][0] for doc in await store.list_all() if doc.get('disabled')) == [0, 1]
+        await store.delete_many_by_name([[0, 0, 0], [2, 0, 0]])
+        assert [doc['name_indexes'][0] for doc in await store.list_all()] == [1]
+        assert await store.find_by_mention(1, [7]) == await store.list_all()
+        await store.close()
+    asyncio.run(run())
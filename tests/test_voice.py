@@ -0,0 +1,28 @@
+import voice
+
+NOT_CONNECTED = voice.NOT_CONNECTED
+CONNECTED = voice.VoiceFlags(5, 0, 0, 0)
+MUTED = voice.VoiceFlags(5, 0, 1, 0)
+
+
+def test_repeated_transition_is_dropped():
+    recent = voice.RecentEvents()
+    join = (NOT_CONNECTED, CONNECTED, 'session')
+    assert recent.first_time(1, 2, join)
+    assert not recent.first_time(1, 2, join)
+
+
+def test_real_repeats_are_kept():
+    recent = voice.RecentEvents()
+    changes = [(NOT_CONNECTED, CONNECTED), (CONNECTED, NOT_CONNECTED), (NOT_CONNECTED, CONNECTED),
+               (CONNECTED, MUTED), (MUTED, CONNECTED), (CONNECTED, MUTED)]
+    assert all(recent.first_time(1, 2, before_after + ('session',)) for before_after in changes)
+    # other members are tracked separately
+    assert recent.first_time(1, 3, (CONNECTED, MUTED, 'other'))
+
+
+def test_fingerprint_depends_on_the_whole_transition():
+    join = (NOT_CONNECTED, CONNECTED, 'session')
+    assert voice.transition_fingerprint(1, 2, join) == voice.transition_fingerprint(1, 2, join)
+    assert voice.transition_fingerprint(1, 2, join) != voice.transition_fingerprint(1, 2, (CONNECTED, NOT_CONNECTED, 'session'))
+    assert voice.transition_fingerprint(1, 2, join) != voice.transition_fingerprint(1, 2, (NOT_CONNECTED, CONNECTED, 'other'))
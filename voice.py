@@ -0,0 +1,194 @@
+import cache
+
+import collections
+import enum
+
+
+class Action(enum.Enum):
+    JOINS = 'joins'
+    LEAVES = 'leaves'
+    MUTED = 'muted'
+    UNMUTED = 'unmuted'
+    DEAFENED = 'deafened'
+    UNDEAFENED = 'undeafened'
+    STREAMING = 'streaming'
+    UNSTREAMING = 'unstreaming'
+
+
+# Everything about a voice state that we classify transitions by.
+# deaf, mute and stream count how many of the server/self flags are set, like in the original Event code.
+VoiceFlags = collections.namedtuple('VoiceFlags', ['channel_id', 'deaf', 'mute', 'stream'])
+
+NOT_CONNECTED = VoiceFlags(None, 0, 0, 0)
+
+
+def flags_from_state(state):
+    # From a discord.VoiceState.
+    if state is None or state.channel is None: return NOT_CONNECTED
+    return VoiceFlags(state.channel.id, state.deaf + state.self_deaf, state.mute + state.self_mute, state.self_stream + state.self_video)
+
+
+def flags_from_payload(data):
+    # From a raw VOICE_STATE_UPDATE payload.
+    channel_id = data.get('channel_id')
+    if channel_id is None: return NOT_CONNECTED
+    return VoiceFlags(int(channel_id),
+                      bool(data.get('deaf')) + bool(data.get('self_deaf')),
+                      bool(data.get('mute')) + bool(data.get('self_mute')),
+                      bool(data.get('self_stream')) + bool(data.get('self_video')))
+
+
+def classify(before, after):
+    # Returns the Action that happened between two VoiceFlags, or None if nothing we care about changed.
+    if before.channel_id is None and after.channel_id is not None:
+        return Action.JOINS
+    if after.channel_id is None and before.channel_id is not None:
+        return Action.LEAVES
+
+    # it is important to check for deafening before muting, because the default Discord client applies both changes at the same time
+    if before.deaf < after.deaf: return Action.DEAFENED
+    if before.deaf > after.deaf: return Action.UNDEAFENED
+
+    if before.mute < after.mute: return Action.MUTED
+    if before.mute > after.mute: return Action.UNMUTED
+
+    if before.stream < after.stream: return Action.STREAMING
+    if before.stream > after.stream: return Action.UNSTREAMING
+
+    return None
+
+
+class VoiceStateMap:
+    # Our own compact copy of everybody's voice state, for the raw fast path, which bypasses discord.py's voice state cache.
+    def __init__(self):
+        self.states = dict()  # (guild id, user id) -> VoiceFlags
+        self.occupancy = collections.Counter()  # (guild id, channel id) -> number of people connected
+
+    def seed(self, guild):
+        self.forget_guild(guild.id)
+        for channel in list(guild.voice_channels) + list(guild.stage_channels):
+            for user_id, state in channel.voice_states.items():
+                self.states[(guild.id, user_id)] = flags_from_state(state)
+                self.occupancy[(guild.id, channel.id)] += 1
+
+    def forget_guild(self, guild_id):
+        for key in [k for k in self.states if k[0] == guild_id]:
+            del self.states[key]
+        for key in [k for k in self.occupancy if k[0] == guild_id]:
+            del self.occupancy[key]
+
+    def swap(self, guild_id, user_id, after):
+        # Stores the new state and returns the previous one.
+        key = (guild_id, user_id)
+        before = self.states.get(key, NOT_CONNECTED)
+        if before.channel_id != after.channel_id:
+            if before.channel_id is not None:
+                self.occupancy[(guild_id, before.channel_id)] -= 1
+                if self.occupancy[(guild_id, before.channel_id)] <= 0:
+                    del self.occupancy[(guild_id, before.channel_id)]
+            if after.channel_id is not None:
+                self.occupancy[(guild_id, after.channel_id)] += 1
+        if after.channel_id is None:
+            self.states.pop(key, None)
+        else:
+            self.states[key] = after
+        return before
+
+    def __len__(self):
+        return len(self.states)
+
+
+class RuleIndex:
+    # Answers "could any rule match this event?" from the rule store's in-memory snapshot, without building any models.
+    # Per guild and action, we keep which channels (None meaning any) each member, role or anybody has rules for.
+    def __init__(self, store):
+        self.store = store
+        self.compiled = dict()  # guild id -> {action value -> {'anyone': set, 'member': {id: set}, 'role': {id: set}}}
+        store.listeners.append(self.invalidate)
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.compiled.clear()
+        else:
+            self.compiled.pop(guild_id, None)
+
+    def _compile(self, guild_id):
+        by_action = dict()
+        for doc in self.store.snapshot.get(guild_id, dict()).values():
+            if doc.get('disabled'): continue
+            trigger = doc['trigger']
+            entry = by_action.setdefault(trigger['action'], {'anyone': set(), 'member': dict(), 'role': dict()})
+            userlike = trigger.get('userlike')
+            if userlike is None:
+                entry['anyone'].add(trigger.get('channel'))
+            else:
+                entry[userlike['type']].setdefault(userlike['id'], set()).add(trigger.get('channel'))
+        self.compiled[guild_id] = by_action
+        return by_action
+
+    def might_match(self, guild_id, user_id, role_ids, action, channel_id):
+        if self.store.snapshot_loaded_at is None: return True  # we don't know the rules yet
+        by_action = self.compiled.get(guild_id)
+        if by_action is None:
+            by_action = self._compile(guild_id)
+        entry = by_action.get(action.value)
+        if entry is None: return False
+        channel_sets = [entry['anyone'], entry['member'].get(user_id, ())] + [entry['role'].get(i, ()) for i in role_ids]
+        return any(None in channels or channel_id in channels for channels in channel_sets)
+
+
+class MentionIndex:
+    # Reverse map from member and role IDs to the rules that mention them, built per guild from the snapshot
+    # the first time it is needed, and rebuilt whenever that guild's rules change.
+    def __init__(self, store):
+        self.store = store
+        self.compiled = dict()  # guild id -> {member or role id -> [rule documents]}
+        store.listeners.append(self.invalidate)
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.compiled.clear()
+        else:
+            self.compiled.pop(guild_id, None)
+
+    def _compile(self, guild_id):
+        by_mention = dict()
+        for doc in self.store.snapshot.get(guild_id, dict()).values():
+            for userlike in doc.get('users_to_mention') or []:
+                by_mention.setdefault(userlike['id'], []).append(doc)
+        self.compiled[guild_id] = by_mention
+        return by_mention
+
+    def rules_mentioning(self, guild_id, mention_ids):
+        # Returns None if the snapshot was not loaded yet, so that the caller can ask the store instead.
+        if self.store.snapshot_loaded_at is None: return None
+        by_mention = self.compiled.get(guild_id)
+        if by_mention is None:
+            by_mention = self._compile(guild_id)
+        found = dict()
+        for mention_id in mention_ids:
+            for doc in by_mention.get(mention_id, ()):
+                found[tuple(doc['name_indexes'])] = doc
+        return list(found.values())
+
+
+class RecentEvents:
+    # Drops a voice state transition that repeats the previous transition of the same member, like the ones the gateway
+    # sends again after a RESUME. A transition is (before flags, after flags, voice session ID). A real change can never
+    # repeat the member's previous transition, because its "before" is that transition's "after", so join, leave, join
+    # or mute, unmute, mute all get through. Members are forgotten after `window` seconds, or beyond `max_size` members.
+    def __init__(self, max_size=10000, window=300):
+        self.last = cache.LRUCache(max_size, ttl=window)  # (guild id, member id) -> their last transition
+
+    def first_time(self, guild_id, user_id, transition):
+        key = (guild_id, user_id)
+        if self.last.get(key) == transition:
+            return False
+        self.last.put(key, transition)
+        return True
+
+
+def transition_fingerprint(guild_id, user_id, transition):
+    # Identical in every process that receives this transition, for claiming it in the rule store.
+    before, after, session_id = transition
+    return ':'.join(str(i) for i in [guild_id, user_id, session_id] + list(before) + list(after))